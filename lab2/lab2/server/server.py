@@ -8,14 +8,78 @@
 # ------------------------------------------------------------------------------------------------------
 # We import various libraries
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # Socket specifically designed to handle HTTP requests
+from SocketServer import ThreadingMixIn  # Handle each connection in its own thread
 import sys  # Retrieve arguments
 from urlparse import parse_qs  # Parse POST data
+import json  # Delta updates of the board
+import zlib  # Compression of the board (gzip, deflate)
 from httplib import HTTPConnection  # Create a HTTP connection, as a client (for POST requests to the other vessels)
 from urllib import urlencode  # Encode POST content into the HTTP header
 from codecs import open  # Open a file
-from threading import Thread # Thread Management
+from struct import pack, unpack_from, calcsize  # Binary messages between vessels
+from Queue import Queue, Full  # Thread-safe queue
+from itertools import chain, islice  # Chunks of the board between the head and the tail of the page, log
+from collections import deque  # FIFO of messages
+from select import select  # Wait for the sockets (idle connections)
+from cStringIO import StringIO  # Responses in memory (streams left by the browser)
+import socket  # Socket errors
+from threading import Thread, Lock, RLock, Condition # Thread Management
 from random import randint	#random number
-from time import sleep
+from bisect import bisect_left, bisect_right, insort  # Sorted list of the keys
+import re  # Slots of the templates
+from time import sleep, time
+from math import sqrt, log10, erfc  # Suspicion level of the failure detector
+
+
+# ------------------------------------------------------------------------------------------------------
+
+# Templates compiled once
+# A template is split once into its static segments and the slots between them: %s and %d in their order
+# (as for the % operator), and the named slots <!-- slot:name --> (leader, entries, ...)
+TEMPLATE_SLOT = re.compile(r'%([sd%])|<!-- slot:(\w+) -->')
+
+class Template:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, text):
+        # the static text around the slots (one more segment than slots)
+        self.segments = []
+        # the slots: their position for %s and %d, their name for the named slots
+        self.slots = []
+        formats = []
+        segment = ''
+        position = 0
+        for match in TEMPLATE_SLOT.finditer(text):
+            segment += text[position:match.start()]
+            position = match.end()
+            if match.group(1) == '%':
+                segment += '%'
+                continue
+            self.segments.append(segment)
+            formats.append(segment.replace('%', '%%'))
+            if match.group(1) is not None:
+                self.slots.append(len(self.slots))
+                formats.append('%' + match.group(1))
+            else:
+                self.slots.append(match.group(2))
+                formats.append('%s')
+            segment = ''
+        segment += text[position:]
+        self.segments.append(segment)
+        formats.append(segment.replace('%', '%%'))
+        # the segments and the slots are filled by a single formatting
+        self.format = ''.join(formats)
+
+    # ------------------------------------------------------------------------------------------------------
+    # The template filled with the values of its slots, in their order
+    def render(self, *values):
+        return self.format % values
+
+    # ------------------------------------------------------------------------------------------------------
+    # The template filled with the values of its named slots (empty when not given)
+    def fill(self, **values):
+        return self.format % tuple([values.get(slot, '') for slot in self.slots])
+
+# ------------------------------------------------------------------------------------------------------
 
 
 # ------------------------------------------------------------------------------------------------------
@@ -26,12 +90,88 @@ try:
     board_frontpage_header_template = open('server/board_frontpage_header_template.html', 'r').read()
     boardcontents_template = open('server/boardcontents_template.html', 'r').read()
     entry_template = open('server/entry_template.html', 'r').read()
+    # the templates filled at each request are compiled once
+    boardcontents_compiled = Template(boardcontents_template)
+    entry_compiled = Template(entry_template)
+    board_frontpage_header_compiled = Template(board_frontpage_header_template)
 except Exception as e:
     print(e)
 
 # ------------------------------------------------------------------------------------------------------
 # Static variables definitions
 PORT_NUMBER = 8080
+# Serving engine used when none is given on the command line: threads (the only one of this lab)
+SERVING_ENGINE = "threads"
+# Number of vessels contacted in parallel when a message is propagated (at least: every vessel gets
+# PIPELINE_DEPTH workers, so the vessels which do not answer never hold the workers of the others)
+FANOUT_PARALLELISM = 8
+# Content type of the binary messages between vessels
+BINARY_CONTENT_TYPE = "application/x-vessel-messages"
+# Workers of the sender queue (contacting the leader or the neighbour blocks a worker until it answers)
+SENDER_WORKERS = 4
+# Maximum number of works waiting in the sender queue
+SENDER_QUEUE_SIZE = 1000
+# When the sender queue is full, the request waits (True) or its propagation is rejected (False)
+SENDER_QUEUE_BLOCK = True
+# Maximum number of replication messages sent to a vessel in one batch
+BATCH_SIZE = 64
+# Batches sent to a vessel at the same time, without waiting for the previous ones (the vessel puts them
+# back in the order of the log), at most the connections of the pool to a vessel
+PIPELINE_DEPTH = 4
+# Maximum number of batches waiting for a vessel, the oldest ones are dropped beyond (the vessel asks for them
+# when it sees the gap): far less operations than the replication log keeps, so they are still in it
+FANOUT_QUEUE_SIZE = 64
+# Maximum number of writes done and logged together by the leader (group commit)
+GROUP_COMMIT_SIZE = 256
+# Time (in seconds) a replication message waits for others before its batch is sent
+BATCH_WINDOW = 0.01
+# Number of changes of the store kept for the delta updates of the board (/board?since=N)
+CHANGES_KEPT = 1000
+# Changes kept for a subscriber of /board/events before it gets the whole board again
+EVENTS_BUFFER_SIZE = 100
+# Time (in seconds) after which an idle stream of board events is checked with a comment
+EVENTS_KEEPALIVE = 15
+# Entries of the board rendered and sent together when the board is streamed
+STREAM_CHUNK_ENTRIES = 100
+# Entries in a page of the board (/?offset=O&limit=N or /?from=K&to=K&limit=N), when no limit is given
+BOARD_PAGE_SIZE = 100
+# Level of the compression of the board for the browsers accepting it (1 fastest - 9 smallest)
+COMPRESSION_LEVEL = 6
+# Operations kept in the replication log of the leader (a vessel further behind gets the whole store)
+REPLICATION_LOG_SIZE = 10000
+# Time (in seconds) a gap in the sequence may last before the missing operations are asked to the leader
+# (the batches sent at the same time may arrive in another order)
+GAP_TIMEOUT = 0.1
+# Fields of the replication messages: the leader which sent them and the round it was elected in (a vessel only
+# applies the messages of its leader for its round), the sequence number of the operation in the log of the
+# leader, then the operation
+REPLICATION_FIELDS = ['leader', 'round', 'sequence', 'path', 'action', 'key', 'value']
+# Time (in seconds) after its start during which a vessel waits for its neighbour to start too
+# (a neighbour not answering later is dead)
+ELECTION_STARTUP_TIMEOUT = 5
+# Time (in seconds) between two tries to contact a neighbour which is starting
+ELECTION_RETRY_INTERVAL = 0.1
+# Time (in seconds) between two heartbeats sent to the leader and to the neighbour on the ring
+HEARTBEAT_INTERVAL = 1.0
+# Number of times the suspicion levels are checked between two heartbeats
+HEARTBEAT_CHECKS = 10
+# Time (in seconds) a heartbeat waits for its answer
+HEARTBEAT_TIMEOUT = 0.5
+# Suspicion level (phi) above which a vessel is dead: 8 is 1 chance in 10^8 that it is only late
+PHI_THRESHOLD = 8
+# Number of intervals between the heartbeats of a vessel kept for its suspicion level
+HEARTBEAT_WINDOW = 100
+# Smallest standard deviation (in seconds) of these intervals: on a steady network they barely vary, and
+# phi would rise at the first late heartbeat
+HEARTBEAT_MIN_DEVIATION = 0.2
+# Time (in seconds) a vessel may stay silent on top of its usual interval before it is suspected at all
+# (a busy or paused vessel, a lost answer): with the deviation above, phi reaches 8 after about 4 heartbeats
+HEARTBEAT_ACCEPTABLE_PAUSE = 2.0
+
+# ------------------------------------------------------------------------------------------------------
+# Locks
+# The store is shared by all the request handling threads
+mutex = RLock()
 
 # ------------------------------------------------------------------------------------------------------
 #     Protocols of communications - actions                 #       from   ->    to         #
@@ -58,103 +198,1046 @@ del_leader = "delete_entry_to_leader"                       #   normal_vessel ->
 #in normal vessel                                           #                               #
 del_vessels = "delete_on_vessels"                           #   eader -> normal_vessel      #
                                                             #                               #
-#leader election algorithm                                  #                               #
+#the leader sends the whole store to a normal vessel        #                               #
+#which is too far behind its replication log                #                               #
+snapshot_vessels = "snapshot_on_vessels"                    #   leader -> normal_vessel     #
+                                                            #                               #
+#leader election algorithm: only the best candidate met     #                               #
+#goes on around the ring (round:number)                     #                               #
 leader_elec = "leader_election"                             #   vessel -> vessel            #
                                                             #                               #
+#the candidate which came back to its vessel is elected,    #                               #
+#the vessels learn it around the ring (round:number)        #                               #
+leader_elected = "leader_elected"                           #   vessel -> vessel            #
+                                                            #                               #
 #a node sends a message to the neighbour to warn that       #                               #
 #some node died during the leader election                  #                               #
 dead_neighbour = "dead_neighbour_in_election"               #   vessel -> vessel            #
                                                             #                               #
-#when a vessel detects that the leader might be dead        #                               #
-#choose a new leader                                        #                               #
-new_leader = "leader_dead_new_election"                     #   vessel -> new_leader        #
-                                                            #                               #
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+# Binary format of the messages between vessels (POST on /replication)
+# header:  number of fields (unsigned short), number of messages (unsigned int)
+#          then the name of every field: length (unsigned char) + bytes
+# message: the length of every field (unsigned int each, one struct), then the raw bytes of the fields
+# Decoding gives the same {field: [value of message 1, value of message 2, ...]} as parse_qs
+def encode_messages(fields, messages):
+    parts = [pack("!HI", len(fields), len(messages))]
+    for field in fields:
+        parts.append(pack("!B", len(field)))
+        parts.append(field)
+    lengths_format = "!%dI" % len(fields)
+    for message in messages:
+        # the values are sent as strings, like urlencode does
+        values = [str(value) for value in message]
+        parts.append(pack(lengths_format, *[len(value) for value in values]))
+        parts.extend(values)
+    return "".join(parts)
+
+
+def decode_messages(data):
+    number_fields, number_messages = unpack_from("!HI", data, 0)
+    offset = calcsize("!HI")
+    fields = []
+    for i in range(0, number_fields):
+        length = ord(data[offset])
+        fields.append(data[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    lengths_format = "!%dI" % number_fields
+    lengths_size = calcsize(lengths_format)
+    decoded = dict((field, []) for field in fields)
+    for i in range(0, number_messages):
+        lengths = unpack_from(lengths_format, data, offset)
+        offset += lengths_size
+        for field, length in zip(fields, lengths):
+            decoded[field].append(data[offset:offset + length])
+            offset += length
+    # a truncated content would give cut values
+    if offset != len(data):
+        raise ValueError("Malformed messages: %d bytes expected, %d received" % (offset, len(data)))
+    return decoded
+
+
+# Text of the entries (and of the board) in JSON: they are stored as the bytes posted and json only takes UTF-8,
+# so the invalid bytes are replaced (U+FFFD) instead of failing the whole response
+def json_text(text):
+    if text is None:
+        return None
+    return text.decode('utf-8', 'replace')
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Pool of persistent (keep-alive) connections to the other vessels
+# Each vessel IP has at most max_per_vessel sockets open, an idle socket is reused by the next message
+# instead of paying a new TCP handshake, and a socket that looks closed or broken is replaced by a new one
+class VesselConnectionPool:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, port, max_per_vessel=4, timeout=30, max_idle=30):
+        # port used by every vessel
+        self.port = port
+        # maximum number of sockets (idle and busy) towards one vessel
+        self.max_per_vessel = max_per_vessel
+        # timeout of a request, after which the connection fails if nothing happened
+        self.timeout = timeout
+        # an idle socket older than this (in seconds) is closed instead of reused
+        self.max_idle = max_idle
+        # idle connections of each vessel: vessel_ip -> [(connection, last time used), ...]
+        self.idle = {}
+        # number of sockets currently opened towards each vessel: vessel_ip -> int
+        self.opened = {}
+        # protects idle and opened, and wakes up the threads waiting for a free socket
+        self.condition = Condition(Lock())
+
+    # ------------------------------------------------------------------------------------------------------
+    # An idle connection is healthy if it is not too old and the vessel did not close it meanwhile
+    def is_healthy(self, connection, last_used):
+        if time() - last_used > self.max_idle:
+            return False
+        # not connected yet, it will connect on the next request
+        if connection.sock is None:
+            return True
+        try:
+            readable = select([connection.sock], [], [], 0)[0]
+        except Exception:
+            return False
+        # nothing should be readable on an idle keep-alive socket, otherwise the vessel closed it
+        return not readable
+
+    # ------------------------------------------------------------------------------------------------------
+    # Take a connection towards vessel_ip, waiting if all of its sockets are busy
+    def acquire(self, vessel_ip):
+        with self.condition:
+            while True:
+                idle = self.idle.setdefault(vessel_ip, [])
+                # we reuse the most recently used connection first
+                while idle:
+                    connection, last_used = idle.pop()
+                    if self.is_healthy(connection, last_used):
+                        return connection
+                    connection.close()
+                    self.opened[vessel_ip] -= 1
+                # we can still open a new socket towards this vessel
+                if self.opened.get(vessel_ip, 0) < self.max_per_vessel:
+                    self.opened[vessel_ip] = self.opened.get(vessel_ip, 0) + 1
+                    break
+                self.condition.wait()
+        # We contact vessel:port since we all use the same port
+        return HTTPConnection("%s:%d" % (vessel_ip, self.port), timeout=self.timeout)
+
+    # ------------------------------------------------------------------------------------------------------
+    # Give back a connection, it is kept open only if it can be used again
+    def release(self, vessel_ip, connection, reusable):
+        with self.condition:
+            if reusable:
+                self.idle[vessel_ip].append((connection, time()))
+            else:
+                connection.close()
+                self.opened[vessel_ip] -= 1
+            self.condition.notify()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Send a POST request to vessel_ip and return the HTTP status and the body of the response
+    def post(self, vessel_ip, path, body, headers):
+        while True:
+            connection = self.acquire(vessel_ip)
+            # a reused socket may have been closed by the vessel since the health check
+            reused = connection.sock is not None
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                # the body must be read before the socket can carry the next request
+                answer = response.read()
+            except socket.timeout:
+                # the vessel did not answer, we do not send the message twice
+                self.release(vessel_ip, connection, False)
+                raise
+            except Exception:
+                self.release(vessel_ip, connection, False)
+                if not reused:
+                    raise
+                # we try again on another socket
+                continue
+            self.release(vessel_ip, connection, not response.will_close)
+            return response.status, answer
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Fan-out of the messages sent to the other vessels
+# Every vessel has its own FIFO queue of messages, and a fixed number of workers send them in parallel.
+# A vessel is handled by at most depth workers at a time (with a depth of 1 its messages keep their order),
+# so a slow or dead vessel only keeps a few workers busy while the other vessels are still served by the rest.
+# The messages can be lost (the vessels get them back from the replication log): a queue holds at most size
+# messages, and the messages waiting for a vessel are dropped when one of them fails (function returns False)
+class VesselFanout:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, parallelism, depth=1, size=None):
+        # pending messages of each vessel: vessel_ip -> deque([(function, args), ...])
+        self.queues = {}
+        # maximum number of messages of a vessel sent at the same time
+        self.depth = depth
+        # maximum number of messages waiting for a vessel (None: no limit)
+        self.size = size
+        # messages of each vessel being sent, and places of each vessel in the ready queue
+        self.sending = {}
+        self.scheduled = {}
+        # vessels with a pending message which can be sent now (a vessel is there once for each of them)
+        self.ready = Queue()
+        # protects the queues of the vessels
+        self.lock = Lock()
+        # the workers are started once and live as long as the server
+        for i in range(0, parallelism):
+            worker = Thread(target=self.work)
+            # We kill the process if we kill the server
+            worker.daemon = True
+            worker.start()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Queue a message for vessel_ip, function(*args) is called by a worker to send it
+    def send(self, vessel_ip, function, *args):
+        with self.lock:
+            queue = self.queues.setdefault(vessel_ip, deque())
+            if self.size is not None and len(queue) >= self.size:
+                # the oldest message makes room for the new one
+                queue.popleft()
+            queue.append((function, args))
+            self.schedule(vessel_ip)
+
+    # ------------------------------------------------------------------------------------------------------
+    # The vessel goes in the ready queue if one more of its messages can be sent (the lock must be held)
+    def schedule(self, vessel_ip):
+        scheduled = self.scheduled.get(vessel_ip, 0)
+        if scheduled < len(self.queues[vessel_ip]) and scheduled + self.sending.get(vessel_ip, 0) < self.depth:
+            self.scheduled[vessel_ip] = scheduled + 1
+            self.ready.put(vessel_ip)
+
+    # ------------------------------------------------------------------------------------------------------
+    # Number of messages waiting for each vessel
+    def pending(self):
+        with self.lock:
+            return dict((vessel_ip, len(queue)) for vessel_ip, queue in self.queues.items())
+
+    # ------------------------------------------------------------------------------------------------------
+    # Loop of a worker: send the oldest message of a ready vessel
+    def work(self):
+        while True:
+            vessel_ip = self.ready.get()
+            with self.lock:
+                self.scheduled[vessel_ip] -= 1
+                if not self.queues[vessel_ip]:
+                    # its messages were dropped
+                    continue
+                self.sending[vessel_ip] = self.sending.get(vessel_ip, 0) + 1
+                function, args = self.queues[vessel_ip].popleft()
+            try:
+                sent = function(*args)
+            except Exception as e:
+                print "Error while sending to %s" % vessel_ip
+                print(e)
+                sent = False
+            with self.lock:
+                self.sending[vessel_ip] -= 1
+                if sent is False and self.queues[vessel_ip]:
+                    # the vessel does not answer, its next messages would wait for nothing
+                    print "Vessel %s does not answer, %d messages dropped" % (vessel_ip, len(self.queues[vessel_ip]))
+                    self.queues[vessel_ip].clear()
+                # the vessel goes back in the ready queue, after the other ready vessels
+                self.schedule(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Batches of replication messages
+# The messages for a vessel are collected during a short window (or until the batch is full) and are
+# then sent together as one batch, through the fan-out so the batches of a vessel keep their order
+class ReplicationBatcher:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, fanout, send_batch, size, window):
+        # the fan-out sending the batches
+        self.fanout = fanout
+        # send_batch(vessel_ip, messages) sends one batch to a vessel
+        self.send_batch = send_batch
+        # maximum number of messages in a batch
+        self.size = size
+        # time (in seconds) a message may wait for other messages
+        self.window = window
+        # messages collected for each vessel: vessel_ip -> [message, ...]
+        self.batches = {}
+        # protects the batches, and wakes up the flusher when a message arrives
+        self.condition = Condition(Lock())
+        flusher = Thread(target=self.run)
+        # We kill the process if we kill the server
+        flusher.daemon = True
+        flusher.start()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Add a message to the batch of vessel_ip
+    def add(self, vessel_ip, message):
+        with self.condition:
+            batch = self.batches.setdefault(vessel_ip, [])
+            batch.append(message)
+            if len(batch) >= self.size:
+                self.flush_vessel(vessel_ip)
+            else:
+                self.condition.notify()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Hand the batch of vessel_ip to the fan-out (the condition must be held)
+    def flush_vessel(self, vessel_ip):
+        batch = self.batches.pop(vessel_ip, None)
+        if batch:
+            self.fanout.send(vessel_ip, self.send_batch, vessel_ip, batch)
+
+    # ------------------------------------------------------------------------------------------------------
+    # Loop of the flusher: the first message of a window starts it, all the batches are sent at its end
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.batches:
+                    self.condition.wait()
+            sleep(self.window)
+            with self.condition:
+                for vessel_ip in self.batches.keys():
+                    self.flush_vessel(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Group commit
+# The writes of the requests wait together while the previous group is done, the next group takes all of them
+# (up to size) and commit(writes) does them at once: one lock, one range of keys and of sequence numbers.
+# A lone write is done at once, under load the groups grow by themselves
+class GroupCommit:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, commit, size):
+        # commit(writes) does a group of writes and returns their results
+        self.commit = commit
+        # maximum number of writes in a group
+        self.size = size
+        # writes waiting for the next group: [(write, [result, done]), ...]
+        self.waiting = []
+        # protects the waiting writes, wakes up the committer and the requests of the group done
+        self.condition = Condition(Lock())
+        committer = Thread(target=self.run)
+        # We kill the process if we kill the server
+        committer.daemon = True
+        committer.start()
+
+    # ------------------------------------------------------------------------------------------------------
+    # We wait for a write to be done with its group and return its result
+    def submit(self, write):
+        slot = [None, False]
+        with self.condition:
+            self.waiting.append((write, slot))
+            self.condition.notify_all()
+            while not slot[1]:
+                self.condition.wait()
+        return slot[0]
+
+    # ------------------------------------------------------------------------------------------------------
+    # Loop of the committer
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.waiting:
+                    self.condition.wait()
+                group = self.waiting[:self.size]
+                del self.waiting[:self.size]
+            try:
+                results = self.commit([write for write, slot in group])
+            except Exception as e:
+                print "Error in the group commit"
+                print(e)
+                results = [None] * len(group)
+            with self.condition:
+                for (write, slot), result in zip(group, results):
+                    slot[0] = result
+                    slot[1] = True
+                self.condition.notify_all()
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Outbound sender queue
+# The propagation work of the requests goes into one bounded queue drained by a fixed set of workers,
+# instead of a new thread per request. When the queue is full the caller waits, or its work is rejected
+class SenderQueue:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, workers, size, block):
+        # pending work: (function, args)
+        self.queue = Queue(size)
+        # wait for a free place when the queue is full, or reject the work
+        self.block = block
+        # the workers are started once and live as long as the server
+        for i in range(0, workers):
+            worker = Thread(target=self.work)
+            # We kill the process if we kill the server
+            worker.daemon = True
+            worker.start()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Queue function(*args), we return False if it was rejected because the queue is full
+    def submit(self, function, *args):
+        if self.block and self.queue.full():
+            print "Sender queue full (%d waiting), %s waits" % (self.depth(), function.__name__)
+        try:
+            self.queue.put((function, args), self.block)
+        except Full:
+            print "Sender queue full (%d waiting), %s rejected" % (self.depth(), function.__name__)
+            return False
+        return True
+
+    # ------------------------------------------------------------------------------------------------------
+    # Number of works waiting in the queue
+    def depth(self):
+        return self.queue.qsize()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Loop of a worker
+    def work(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                print "Error in %s" % function.__name__
+                print(e)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Failure detector (phi accrual)
+# Every HEARTBEAT_INTERVAL the vessels monitored (the leader and the neighbour on the ring) receive a heartbeat,
+# the time of each answer is kept. The suspicion level of a vessel (phi) grows with the time since its last
+# answer, compared to the usual intervals between its answers: phi = -log10(probability that the answer is
+# only late). Above the threshold the vessel is dead and suspect(vessel_ip) is called, without waiting for a
+# request to fail on it. The vessels found dead still get a heartbeat from time to time, one of them at each
+# interval, so a vessel which answers again is found back
+class FailureDetector:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, interval, checks, threshold, window, pause, min_deviation, monitored, ping, suspect, probed):
+        # time (in seconds) between two heartbeats
+        self.interval = interval
+        # number of checks of the suspicion levels between two heartbeats
+        self.checks = checks
+        # suspicion level above which a vessel is dead
+        self.threshold = threshold
+        # number of intervals kept for each vessel
+        self.window = window
+        # time (in seconds) without heartbeat accepted before a vessel is suspected at all
+        self.pause = pause
+        # lowest deviation of the intervals, so that a vessel with very regular answers is not suspected too soon
+        self.min_deviation = min_deviation
+        # monitored() gives the vessels to monitor now
+        self.monitored = monitored
+        # ping(vessel_ip) sends a heartbeat, True if the vessel answered
+        self.ping = ping
+        # suspect(vessel_ip) is called when a vessel is dead
+        self.suspect = suspect
+        # probed() gives the vessels found dead, which get a heartbeat in turn (ping tells when one is back)
+        self.probed = probed
+        # the turn of the vessels found dead
+        self.probe_turn = 0
+        # the answers of each vessel monitored:
+        # vessel_ip -> [time of the last answer (or of the start of the monitoring), deque of the intervals, answered]
+        self.history = {}
+        checker = Thread(target=self.run)
+        # We kill the process if we kill the server
+        checker.daemon = True
+        checker.start()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Suspicion level of a vessel now (the intervals are taken as a normal distribution)
+    def phi(self, vessel_ip, now):
+        last, intervals = self.history[vessel_ip][:2]
+        if intervals:
+            mean = sum(intervals) / len(intervals)
+            deviation = sqrt(sum((interval - mean) ** 2 for interval in intervals) / len(intervals))
+        else:
+            # no answer yet since the vessel is monitored, it should answer at each heartbeat
+            mean = self.interval
+            deviation = 0
+        # a few missed heartbeats are accepted before the vessel is suspected at all
+        mean += self.pause
+        deviation = max(deviation, self.min_deviation)
+        late = 0.5 * erfc((now - last - mean) / (deviation * sqrt(2)))
+        return -log10(max(late, 1e-300))
+
+    # ------------------------------------------------------------------------------------------------------
+    # Loop of the checker: heartbeats to the vessels monitored, then the dead ones are reported
+    def run(self):
+        while True:
+            monitored = self.monitored()
+            now = time()
+            # a vessel starts with its monitoring, the vessels not monitored anymore are forgotten
+            for vessel_ip in self.history.keys():
+                if vessel_ip not in monitored:
+                    del self.history[vessel_ip]
+            for vessel_ip in monitored:
+                if vessel_ip not in self.history:
+                    self.history[vessel_ip] = [now, deque(maxlen=self.window), False]
+            for vessel_ip in monitored:
+                if self.ping(vessel_ip):
+                    answered = time()
+                    history = self.history[vessel_ip]
+                    # the start of the monitoring is not an answer, its interval is not kept
+                    if history[2]:
+                        history[1].append(answered - history[0])
+                    history[0] = answered
+                    history[2] = True
+            # one of the vessels found dead, in turn
+            probed = [vessel_ip for vessel_ip in self.probed() if vessel_ip not in monitored]
+            if probed:
+                self.probe_turn = (self.probe_turn + 1) % len(probed)
+                self.ping(probed[self.probe_turn])
+            # the suspicion levels are checked several times between two heartbeats
+            for i in range(0, self.checks):
+                sleep(self.interval / self.checks)
+                now = time()
+                for vessel_ip in monitored:
+                    if vessel_ip in self.history and self.phi(vessel_ip, now) > self.threshold:
+                        # monitored again from scratch if it is still the leader or the neighbour
+                        del self.history[vessel_ip]
+                        self.suspect(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Subscribers of the board events (/board/events)
+# Each subscriber has its own bounded buffer of changes: a slow browser never holds the store, when
+# its buffer is full the changes are dropped and it gets the whole board again
+class BoardSubscriber:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, size):
+        # changes not sent yet: (version, key)
+        self.changes = deque()
+        # maximum number of changes in the buffer
+        self.size = size
+        # changes were dropped, the whole board must be sent
+        self.overflow = False
+        # protects the buffer, and wakes up the stream when a change arrives
+        self.condition = Condition(Lock())
+
+    # ------------------------------------------------------------------------------------------------------
+    # A change of the store (called by the thread changing the store)
+    def push(self, version, key):
+        with self.condition:
+            if len(self.changes) >= self.size:
+                self.changes.clear()
+                self.overflow = True
+            elif not self.overflow:
+                self.changes.append((version, key))
+            self.condition.notify()
+
+    # ------------------------------------------------------------------------------------------------------
+    # We wait for changes (at most timeout seconds) and take them all: (overflow, [(version, key), ...])
+    def pop(self, timeout):
+        with self.condition:
+            if not self.changes and not self.overflow:
+                self.condition.wait(timeout)
+            changes = (self.overflow, list(self.changes))
+            self.changes.clear()
+            self.overflow = False
+            return changes
+
+# ------------------------------------------------------------------------------------------------------
+
+class BoardEvents:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, buffer_size):
+        # size of the buffer of each subscriber
+        self.buffer_size = buffer_size
+        # the subscribers connected
+        self.subscribers = set()
+        # protects the set of subscribers
+        self.lock = Lock()
+
+    # ------------------------------------------------------------------------------------------------------
+    # A new subscriber, it receives the changes from now on
+    def subscribe(self):
+        subscriber = BoardSubscriber(self.buffer_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    # ------------------------------------------------------------------------------------------------------
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    # ------------------------------------------------------------------------------------------------------
+    # A change of the store is pushed to all the subscribers
+    def publish(self, version, key):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.push(version, key)
+
+    # ------------------------------------------------------------------------------------------------------
+    # Number of subscribers connected
+    def count(self):
+        with self.lock:
+            return len(self.subscribers)
+
 # ------------------------------------------------------------------------------------------------------
 
 
 # ------------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------------
 class BlackboardServer(HTTPServer):
+    # the responses cannot stay open (the events of the board are only polled)
+    streaming = False
     # ------------------------------------------------------------------------------------------------------
     def __init__(self, server_address, handler, node_id, vessel_list):
         # We call the super init
         HTTPServer.__init__(self, server_address, handler)
         # we create the dictionary of values
         self.store = {}
+        # the keys of the store, sorted (order of the board)
+        self.keys = []
         # We keep a variable of the next id to insert
         self.current_key = -1
+        # Version of the store, incremented by each add, modify and delete
+        self.version = 0
+        # Contents of the board rendered for a version of the store, in chunks: (version, [html, ...])
+        self.board_cache = None
+        # The pages with the board compressed for a version of the store: (encoding, head, tail) -> (version, bytes)
+        self.compressed_cache = {}
+        # Start of the server (in ms), in the ETags of the versions of the board
+        self.started = int(time() * 1000)
+        # The last changes of the store: (version, key), for the delta updates of the board
+        self.changes = deque(maxlen=CHANGES_KEPT)
+        # The browsers receiving the changes of the board as they happen (/board/events)
+        self.board_events = BoardEvents(EVENTS_BUFFER_SIZE)
         # our own ID (IP is 10.1.0.ID)
         self.vessel_id = vessel_id
         # The list of other vessels
         self.vessels = vessel_list
-        #Leader id
+        # The persistent connections to the other vessels
+        self.connection_pool = VesselConnectionPool(PORT_NUMBER)
+        # The workers sending the messages to the other vessels
+        # (PIPELINE_DEPTH workers for each vessel, the other vessels are served while some do not answer)
+        self.fanout = VesselFanout(max(FANOUT_PARALLELISM, PIPELINE_DEPTH * len(vessel_list)), PIPELINE_DEPTH,
+                                   FANOUT_QUEUE_SIZE)
+        # The batches of replication messages, sent through the fan-out
+        self.batcher = ReplicationBatcher(self.fanout, self.contact_vessel_batch, BATCH_SIZE, BATCH_WINDOW)
+        # The workers running the propagation of the requests
+        self.sender = SenderQueue(SENDER_WORKERS, SENDER_QUEUE_SIZE, SENDER_QUEUE_BLOCK)
+        # Replication log of the leader: its last operations (sequence, path, action, key, value)
+        self.replication_log = deque(maxlen=REPLICATION_LOG_SIZE)
+        # Sequence number of the last operation applied to the store (by the leader: the last one logged)
+        self.sequence = 0
+        # Operations received after a gap in the sequence, waiting for the missing ones: sequence -> operation
+        self.out_of_order = {}
+        # Time of the start of the current gap (None without gap)
+        self.gap_since = None
+        # The writes of the leader, done and logged in groups
+        self.group_commit = GroupCommit(self.commit_writes, GROUP_COMMIT_SIZE)
+        # A request for the missing operations is on its way to the leader
+        self.catching_up = False
+        # A new leader was elected: its sequence numbers are not the ones of our history, we need its store
+        self.resync = False
+        #Leader id, and the round of the election in which it was elected
         self.leader_id = -1
-        #list with the random number_vessels
+        self.leader_round = 0
+        #list with the random number_vessels (ours, and the one of the leader)
         self.list_num_rand = {}
+        #round of the election (each new election has its own) and if our candidate is on the ring in this round
+        self.election_round = 0
+        self.participant = False
         #neighbour id
         self.neighbour_id = -1
         self.max_id = 0
-        #list with the nodes dead and the node that are reachable
+        #list with the nodes dead and the node that are reachable, and all of them
         self.list_deads = []
-        self.list_node = vessel_list
+        self.list_node = list(vessel_list)
+        self.list_all = list(vessel_list)
+        # The heartbeats to the leader and to the neighbour, a dead one starts the election or leaves the ring
+        # (the vessels found dead get heartbeats too, they come back when they answer)
+        self.failure_detector = FailureDetector(HEARTBEAT_INTERVAL, HEARTBEAT_CHECKS, PHI_THRESHOLD, HEARTBEAT_WINDOW,
+                                                HEARTBEAT_ACCEPTABLE_PAUSE, HEARTBEAT_MIN_DEVIATION,
+                                                self.monitored_vessels, self.heartbeat_vessel, self.vessel_suspected,
+                                                self.dead_vessels)
 
 # ------------------------------------------------------------------------------------------------------
     # We add a value received to the store
     def add_value_to_store_leader(self, value):
         # We add the value to the store
-        # next id
-        self.current_key = self.current_key + 1
-        # store in the dict
         value = ''.join(value)
-        self.store[self.current_key] = value
+        with mutex:
+            # next id
+            self.current_key = self.current_key + 1
+            # store in the dict, the new key is the last one of the board
+            self.store[self.current_key] = value
+            insort(self.keys, self.current_key)
+            self.store_changed(self.current_key)
+            # the key of the new value
+            return self.current_key
 
 # ------------------------------------------------------------------------------------------------------
     # We add a value received to the store
     def add_value_to_store_normal(self, key, value):
         # We add the value to the store
-        # next id
-        self.current_key = self.current_key + 1
-        # store in the dict
         value = ''.join(value)
-        self.store[key] = value
+        with mutex:
+            # the keys are given by the leader, we only follow them (for the day we are the leader)
+            self.current_key = max(self.current_key, key)
+            # store in the dict (the key is inserted at its place on the board, once)
+            if key not in self.store:
+                insort(self.keys, key)
+            self.store[key] = value
+            self.store_changed(key)
+
+# ------------------------------------------------------------------------------------------------------
+    # We apply a message received from the leader
+    def apply_replicated(self, path, action, key, value):
+        # add_vessels and mod_vessels are the same action, the path tells them apart
+        if path == "/board" and action == add_vessels:
+            # new value
+            self.add_value_to_store_normal(int(key), value)
+        elif action == mod_vessels:
+            # update value
+            self.modify_value_in_store(int(key), value)
+        elif action == del_vessels:
+            # delete value
+            self.delete_value_in_store(int(key))
+
+# ------------------------------------------------------------------------------------------------------
+    # We apply a batch of messages received from the leader, all at once and strictly in the order of its log
+    # (the messages after a missing one wait for it, and the missing ones are asked to the leader)
+    def apply_replicated_batch(self, post_data):
+        messages = zip(*[post_data[field] for field in REPLICATION_FIELDS])
+        if not messages:
+            return
+        leader, leader_round = int(messages[0][0]), int(messages[0][1])
+        # a vessel which missed the election learns its leader from it
+        self.leader_learned(leader, leader_round)
+        messages = [message[2:] for message in messages]
+        # the readers of the store never see half of the batch
+        with mutex:
+            if leader != self.leader_id or leader_round != self.leader_round:
+                #an old leader (or a vessel which thinks it is the leader): its operations are not ours
+                print "Replication from %d (round %d) dropped, our leader is %d (round %d)" % (
+                    leader, leader_round, self.leader_id, self.leader_round)
+                return
+            if messages[0][2] == snapshot_vessels:
+                self.apply_snapshot(messages)
+            for sequence, path, action, key, value in messages:
+                # the operations already applied are not applied twice
+                if int(sequence) > self.sequence and action != snapshot_vessels:
+                    self.out_of_order[int(sequence)] = (path, action, key, value)
+            while self.sequence + 1 in self.out_of_order:
+                self.sequence += 1
+                self.apply_replicated(*self.out_of_order.pop(self.sequence))
+            # a batch sent at the same time as this one may still be on its way: the gap has to last
+            if not self.out_of_order:
+                self.gap_since = None
+            elif self.gap_since is None:
+                self.gap_since = time()
+            gap = self.gap_since is not None and time() - self.gap_since > GAP_TIMEOUT
+        if gap:
+            self.request_catch_up()
+
+# ------------------------------------------------------------------------------------------------------
+    # We replace the store by the one of the leader (called with the mutex)
+    # the first message gives the sequence number and the current key of the leader, the others its entries
+    def apply_snapshot(self, messages):
+        sequence, path, action, current_key, value = messages[0]
+        changed = set(self.keys)
+        self.store = {}
+        self.keys = []
+        for sequence, path, action, key, value in messages[1:]:
+            self.store[int(key)] = value
+            self.keys.append(int(key))
+        self.keys.sort()
+        self.current_key = max(self.current_key, int(current_key))
+        self.sequence = int(sequence)
+        self.resync = False
+        for pending in [pending for pending in self.out_of_order if pending <= self.sequence]:
+            del self.out_of_order[pending]
+        for key in changed.union(self.keys):
+            self.store_changed(key)
+
+# ------------------------------------------------------------------------------------------------------
+    # We ask the leader for the operations we miss, all of them in one request (only one at a time)
+    def request_catch_up(self):
+        with mutex:
+            if self.catching_up or self.leader_id in (-1, self.vessel_id):
+                return
+            self.catching_up = True
+        self.sender.submit(self.catch_up)
+
+    def catch_up(self):
+        try:
+            with mutex:
+                leader = "10.1.0.%d" % self.leader_id
+                # from 0: the whole store of a new leader
+                first = 0 if self.resync else self.sequence + 1
+            # the answer of a vessel which is not the leader anymore is dropped with the replication messages
+            status, answer = self.connection_pool.post(leader, "/replication/catchup", urlencode({'from': first}),
+                                                       {"Content-type": "application/x-www-form-urlencoded"})
+            if status == 200:
+                self.apply_replicated_batch(decode_messages(answer))
+        except Exception as e:
+            print "Error while catching up with the leader"
+            print(e)
+        finally:
+            with mutex:
+                self.catching_up = False
+
+# ------------------------------------------------------------------------------------------------------
+    # The operations of the log of the leader from the sequence number first, for a vessel catching up
+    # (the whole store if they are not in the log anymore, or if the vessel has another history)
+    def replication_since(self, first):
+        with mutex:
+            oldest = self.replication_log[0][0] if self.replication_log else self.sequence + 1
+            if oldest <= first <= self.sequence + 1:
+                return list(islice(self.replication_log, first - oldest, None))
+            snapshot = [(self.sequence, "", snapshot_vessels, self.current_key, "")]
+            snapshot.extend([(self.sequence, "/board", add_vessels, key, self.store[key]) for key in self.keys])
+            return snapshot
 
 # ------------------------------------------------------------------------------------------------------
     # We modify a value received in the store
     def modify_value_in_store(self, key, value):
         # we modify a value in the store if it exists
-        if key in self.store.keys():
-            value = ''.join(value)
-            self.store[key] = value
+        value = ''.join(value)
+        with mutex:
+            if key in self.store:
+                self.store[key] = value
+                self.store_changed(key)
 
 # ------------------------------------------------------------------------------------------------------
     # We delete a value received from the store
     def delete_value_in_store(self, key):
         # we delete a value in the store if it exists
-        if key in self.store.keys():
-            del self.store[key]
+        with mutex:
+            if key in self.store:
+                del self.store[key]
+                del self.keys[bisect_left(self.keys, key)]
+                self.store_changed(key)
+
+# ------------------------------------------------------------------------------------------------------
+    # We record a change of the store (called with the mutex)
+    def store_changed(self, key):
+        self.version += 1
+        self.changes.append((self.version, key))
+        self.board_events.publish(self.version, key)
+
+# ------------------------------------------------------------------------------------------------------
+    # The board rendered for the current version of the store, in chunks (None if it is not rendered yet)
+    def cached_board(self):
+        with mutex:
+            if self.board_cache is not None and self.board_cache[0] == self.version:
+                return self.board_cache[1]
+            return None
+
+# ------------------------------------------------------------------------------------------------------
+    # We render the board chunk by chunk (STREAM_CHUNK_ENTRIES entries), the mutex is only held for a chunk
+    # the chunks are kept as the cache of the board if the store did not change in the meantime
+    def render_board(self):
+        with mutex:
+            version = self.version
+            size = len(self.keys)
+        chunk = boardcontents_compiled.segments[0] #the new entries go into the entries slot of the boardcontents
+        if size > BOARD_PAGE_SIZE:
+            # a large board can also be seen in pages
+            chunk += '<p class="board_pages">%s</p>' % self.page_link("Pages of %d entries" % BOARD_PAGE_SIZE, 0, BOARD_PAGE_SIZE)
+        chunks = [chunk]
+        yield chunk
+        last = None
+        while True:
+            with mutex:
+                # the chunk starts after the last key sent, even if the store changed
+                start = 0 if last is None else bisect_right(self.keys, last)
+                keys = self.keys[start:start + STREAM_CHUNK_ENTRIES]
+                chunk = ''.join([entry_compiled.render("entries/" + str(i), i, self.store[i]) for i in keys]) #create entries
+            if not keys:
+                break
+            last = keys[-1]
+            chunks.append(chunk)
+            yield chunk
+        chunk = boardcontents_compiled.segments[1]
+        chunks.append(chunk)
+        yield chunk
+        with mutex:
+            if self.version == version:
+                self.board_cache = (version, chunks)
+
+# ------------------------------------------------------------------------------------------------------
+    # The contents of the board, rendered once for each version of the store
+    def board_contents(self):
+        chunks = self.cached_board()
+        if chunks is None:
+            chunks = list(self.render_board())
+        return ''.join(chunks)
+
+# ------------------------------------------------------------------------------------------------------
+    # The board between head and tail compressed with gzip or deflate, once for each version of the store
+    def compressed_board(self, head, tail, encoding):
+        with mutex:
+            version = self.version
+            cached = self.compressed_cache.get((encoding, head, tail))
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        chunks = self.cached_board()
+        if chunks is None:
+            chunks = list(self.render_board())
+        # gzip has a header and a trailer around the deflate (zlib) stream
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        data = ''.join([compressor.compress(chunk) for chunk in chain([head], chunks, [tail])]) + compressor.flush()
+        with mutex:
+            # kept only if the board compressed is the one of this version
+            if self.version == version:
+                self.compressed_cache[(encoding, head, tail)] = (version, data)
+        return data
+
+# ------------------------------------------------------------------------------------------------------
+    # A link to a page of the board: by position (offset) or by key (from, to)
+    def page_link(self, text, offset, limit, first=None, last=None):
+        if first is None:
+            query = "offset=%d&amp;limit=%d" % (offset, limit)
+        else:
+            query = "from=%d&amp;limit=%d" % (first, limit)
+            if last is not None:
+                query += "&amp;to=%d" % last
+        return '<a href="/?%s">%s</a>' % (query, text)
+
+# ------------------------------------------------------------------------------------------------------
+    # The contents of the board for a page: limit entries from the position offset, or from the key first
+    # (with the keys up to last), with the links to the previous and the next pages
+    def board_page(self, offset, limit, first=None, last=None):
+        with mutex:
+            keys = self.keys
+            start = offset if first is None else bisect_left(keys, first)
+            end = len(keys) if last is None else bisect_right(keys, last)
+            page = keys[start:min(start + limit, end)]
+            new_entry = [entry_compiled.render("entries/" + str(i), i, self.store[i]) for i in page] #create entries
+            size = len(keys)
+            previous_key = keys[max(0, start - limit)] if 0 < start <= size else None
+        links = []
+        if start > 0:
+            if first is None:
+                links.append(self.page_link("Previous", max(0, start - limit), limit))
+            elif previous_key is not None:
+                links.append(self.page_link("Previous", 0, limit, previous_key, last))
+        if start + len(page) < end:
+            if first is None:
+                links.append(self.page_link("Next", start + len(page), limit))
+            else:
+                links.append(self.page_link("Next", 0, limit, page[-1] + 1, last))
+        if page:
+            status = "Entries %d to %d of %d" % (start, start + len(page) - 1, size)
+        else:
+            status = "No entries in this page (%d on the board)" % size
+        links.append('<a href="/">Whole board</a>')
+        nav = '<p class="board_pages">%s %s</p>' % (status, ' '.join(links))
+        #put the entries of the page into the boardcontents
+        return boardcontents_compiled.fill(entries=nav + ''.join(new_entry))
+
+# ------------------------------------------------------------------------------------------------------
+    # The entry of the board for a key (None if the key is not in the store)
+    def board_entry(self, key):
+        with mutex:
+            if key in self.store:
+                return entry_compiled.render("entries/" + str(key), key, self.store[key])
+            return None
+
+# ------------------------------------------------------------------------------------------------------
+    # The changes of the board after a version: (version, None, [(key, entry or None if deleted)]),
+    # or the whole board (version, contents of the board, None) if these changes are not kept anymore
+    def board_changes(self, since):
+        with mutex:
+            if since == self.version:
+                return (self.version, None, [])
+            if since < 0 or since > self.version or len(self.changes) == 0 or self.changes[0][0] > since + 1:
+                return (self.version, self.board_contents(), None)
+            keys = set()
+            for version, key in reversed(self.changes):
+                if version <= since:
+                    break
+                keys.add(key)
+            return (self.version, None, [(key, self.board_entry(key)) for key in sorted(keys)])
+
+# ------------------------------------------------------------------------------------------------------
+    # The entries of a page of the board for the machine API (JSON): limit entries from the position offset,
+    # or from the key first (with the keys up to last), straight from the store, without the HTML
+    def api_entries(self, offset, limit, first=None, last=None):
+        with mutex:
+            keys = self.keys
+            start = offset if first is None else bisect_left(keys, first)
+            end = len(keys) if last is None else bisect_right(keys, last)
+            page = keys[start:min(start + limit, end)]
+            entries = [{'id': i, 'entry': json_text(self.store[i])} for i in page]
+            version = self.version
+            size = len(keys)
+        return self.api_page(version, size, start, end, limit, first, last, page, entries)
+
+# ------------------------------------------------------------------------------------------------------
+    # We serialize the whole board for the export, one JSON line for each entry (NDJSON), in chunks of
+    # STREAM_CHUNK_ENTRIES entries, the mutex is only held for a chunk (as when the board is rendered)
+    def export_entries(self):
+        last = None
+        while True:
+            with mutex:
+                # the chunk starts after the last key sent, even if the store changed
+                start = 0 if last is None else bisect_right(self.keys, last)
+                keys = self.keys[start:start + STREAM_CHUNK_ENTRIES]
+                chunk = ''.join([json.dumps({'id': i, 'entry': json_text(self.store[i])}) + '\n' for i in keys])
+            if not keys:
+                break
+            last = keys[-1]
+            yield chunk
+
+# ------------------------------------------------------------------------------------------------------
+    # A page of the machine API, with the query of the next page (None after the last page)
+    def api_page(self, version, size, start, end, limit, first, last, page, entries):
+        next_page = None
+        if start + len(page) < end:
+            if first is None:
+                next_page = "/api/entries?offset=%d&limit=%d" % (start + len(page), limit)
+            else:
+                next_page = "/api/entries?from=%d&limit=%d" % (page[-1] + 1, limit)
+                if last is not None:
+                    next_page += "&to=%d" % last
+        return {'version': version, 'total': size, 'offset': start, 'limit': limit,
+                'entries': entries, 'next': next_page}
+
+# ------------------------------------------------------------------------------------------------------
+    # The state of the outbound queues for the monitoring (/api/status): the works waiting in the sender queue
+    # and the messages waiting in the fan-out for each vessel
+    def queue_status(self):
+        return {'sender_queue': self.sender.depth(), 'fanout': self.fanout.pending()}
 
 # ------------------------------------------------------------------------------------------------------
     # Contact a specific vessel with a set of variables to transmit to it
     def contact_vessel(self, vessel_ip, path, action, key, value):
-        # the Boolean variable we will return
-        success = False
         # The variables must be encoded in the URL format, through urllib.urlencode
         post_content = urlencode({'action': action, 'key': key, 'value': value})
-        # the HTTP header must contain the type of data we are transmitting, here URL encoded
-        headers = {"Content-type": "application/x-www-form-urlencoded"}
+        return self.post_to_vessel(vessel_ip, path, post_content)
+
+# ------------------------------------------------------------------------------------------------------
+    # Send an encoded content to a specific vessel
+    def post_to_vessel(self, vessel_ip, path, post_content, content_type="application/x-www-form-urlencoded"):
+        # the Boolean variable we will return
+        success = False
+        # the HTTP header must contain the type of data we are transmitting, URL encoded or binary
+        headers = {"Content-type": content_type}
         # We should try to catch errors when contacting the vessel
         try:
-            # We contact vessel:PORT_NUMBER since we all use the same port
-            # We can set a timeout, after which the connection fails if nothing happened
-            connection = HTTPConnection("%s:%d" % (vessel_ip, PORT_NUMBER), timeout=30)
-            # We only use POST to send data (PUT and DELETE not supported)
-            action_type = "POST"
-            # We send the HTTP request
-            connection.request(action_type, path, post_content, headers)
-            # We retrieve the response
-            response = connection.getresponse()
-            # We want to check the status, the body should be empty
-            status = response.status
+            # We reuse a kept-alive connection of the pool when possible (PUT and DELETE not supported)
+            status, answer = self.connection_pool.post(vessel_ip, path, post_content, headers)
             # If we receive a HTTP 200 - OK
             if status == 200:
                 success = True
@@ -168,18 +1251,49 @@ class BlackboardServer(HTTPServer):
         return success
 
 # ------------------------------------------------------------------------------------------------------
-    # We send a received value from leader to all the other vessels of the system
-    def propagate_value_to_vessels(self, path, action, key, value):
+    # Contact a specific vessel with a batch of messages [(sequence, path, action, key, value), ...]
+    def contact_vessel_batch(self, vessel_ip, messages):
+        # one row per message, the names of the fields are sent only once
+        post_content = encode_messages(REPLICATION_FIELDS, self.leader_messages(messages))
+        return self.post_to_vessel(vessel_ip, "/replication", post_content, BINARY_CONTENT_TYPE)
 
-        if self.leader_id == self.vessel_id or action == new_leader:
-        #if I am the leader
-            # We iterate through the vessel list
-            for vessel in self.vessels:
-                # We should not send it to our own IP, or we would create an infinite loop of updates
-                if vessel != ("10.1.0.%s" % self.vessel_id):
-                    # A good practice would be to try again if the request failed
-                    # Here, we do it only once
-                    check_connec = self.contact_vessel(vessel, path, action, key, value)
+# ------------------------------------------------------------------------------------------------------
+    # The messages of our log (or of our snapshot) with our id and the round we were elected in
+    def leader_messages(self, messages):
+        return [(self.vessel_id, self.leader_round) + tuple(message) for message in messages]
+
+# ------------------------------------------------------------------------------------------------------
+    # We do a group of writes of the leader (path, action, key, value) and log them, all under one lock:
+    # the new entries of the group get consecutive keys, and the group consecutive sequence numbers
+    def commit_writes(self, writes):
+        keys = []
+        with mutex:
+            for path, action, key, value in writes:
+                # add_vessels and mod_vessels are the same action, the path tells them apart
+                if path == "/board":
+                    key = self.add_value_to_store_leader(value)
+                elif action == mod_vessels:
+                    self.modify_value_in_store(key, value)
+                elif action == del_vessels:
+                    self.delete_value_in_store(key)
+                self.log_operation(path, action, key, value)
+                keys.append(key)
+        return keys
+
+# ------------------------------------------------------------------------------------------------------
+    # We log an operation done by the leader with the next sequence number, and send it to all the other vessels
+    # (called with the mutex, right after the operation: the order of the log is the order of the store)
+    def log_operation(self, path, action, key, value):
+        self.sequence += 1
+        message = (self.sequence, path, action, key, value)
+        self.replication_log.append(message)
+        # We iterate through the vessel list
+        for vessel in self.vessels:
+            # We should not send it to our own IP, or we would create an infinite loop of updates
+            if vessel != ("10.1.0.%s" % self.vessel_id):
+                # a message which does not arrive is asked again by the vessel (gap or heartbeat)
+                # The updates of the store wait in the batch of the vessel
+                self.batcher.add(vessel, message)
 
 # ------------------------------------------------------------------------------------------------------
     # We send a received value from a normal vessel to the leader
@@ -189,16 +1303,218 @@ class BlackboardServer(HTTPServer):
             vessel = "10.1.0.%s" % self.leader_id
             check_connec = self.contact_vessel(vessel, path, action, key, value)
             if check_connec == False:
-                #leader is dead
+                self.leader_failed(vessel)
+
+# ------------------------------------------------------------------------------------------------------
+    # The leader is dead: a new election on the ring, the vessels learn the new leader from it
+    def leader_failed(self, vessel):
+        with mutex:
+            #only the first failure (a request or the failure detector) starts the election
+            dead = vessel in self.vessels
+            if dead:
                 self.vessels.remove(vessel)
-                if self.leader_id in self.list_num_rand.keys():
-                    del self.list_num_rand[self.leader_id]
+        if dead:
+            self.start_election()
+
+# ------------------------------------------------------------------------------------------------------
+    # Our neighbour on the ring is dead: the ring goes on with the next vessel alive, which is warned
+    def neighbour_failed(self, vessel):
+        with mutex:
+            if vessel != "10.1.0.%d" % self.neighbour_id:
+                #already found dead, we have a new neighbour
+                return
+            id_dead = self.neighbour_id
+            if vessel in self.list_node:
+                self.list_node.remove(vessel)
+                self.list_deads.append(vessel)
+            vessel_new ="10.1.0.%d" % self.neighbour_id
+
+            #if the neighbour is dead, discover the new neighbour id
+            while vessel_new not in self.list_node:
+                if self.max_id == self.neighbour_id:
+                    self.max_id = self.vessel_id
+                    self.neighbour_id = 1
+                else:
+                    self.neighbour_id += 1
+
+                #address of the destination vessel
+                vessel_new ="10.1.0.%d" % self.neighbour_id
+
+        #warns the new neighbour that
+        action1 = dead_neighbour
+        self.contact_vessel(vessel_new, "/election", action1, id_dead, self.max_id)
+
+# ------------------------------------------------------------------------------------------------------
+    # The vessels watched by the failure detector: the leader and our neighbour on the ring
+    # (not while the vessels are starting, they do not answer yet)
+    def monitored_vessels(self):
+        if time() < self.started / 1000.0 + ELECTION_STARTUP_TIMEOUT:
+            return []
+        monitored = []
+        for i in (self.leader_id, self.neighbour_id):
+            vessel = "10.1.0.%d" % i
+            if i > 0 and i != self.vessel_id and vessel not in monitored:
+                monitored.append(vessel)
+        return monitored
+
+# ------------------------------------------------------------------------------------------------------
+    # The vessels found dead (by us or by the other vessels), the failure detector checks if they are back
+    def dead_vessels(self):
+        with mutex:
+            return [vessel for vessel in self.list_all if vessel != "10.1.0.%d" % self.vessel_id and
+                    (vessel not in self.vessels or vessel not in self.list_node)]
+
+# ------------------------------------------------------------------------------------------------------
+    # A heartbeat to a vessel: True if it answered in time (a new connection, never behind a slow request)
+    def heartbeat_vessel(self, vessel_ip):
+        try:
+            connection = HTTPConnection("%s:%d" % (vessel_ip, PORT_NUMBER), timeout=HEARTBEAT_TIMEOUT)
+            try:
+                connection.request("GET", "/heartbeat")
+                response = connection.getresponse()
+                if response.status != 200:
+                    return False
+                # the vessel answers with its last sequence number, and its leader with the round it was elected in
+                # and its random number (-1 if not known)
+                sequence, leader_round, leader, number = [int(i) for i in response.read().split(':')]
+            finally:
+                connection.close()
+        except Exception:
+            return False
+        self.vessel_answered(vessel_ip)
+        self.leader_learned(leader, leader_round, number if number >= 0 else None)
+        # the last operations of the leader may have been lost (or its store not received yet)
+        if vessel_ip == "10.1.0.%d" % self.leader_id and (sequence > self.sequence or self.resync):
+            self.request_catch_up()
+        return True
 
-                #new leader
-                self.leader_id = max(self.list_num_rand, key = self.list_num_rand.get)
-                action = new_leader
-                self.propagate_value_to_vessels(None, action, self.leader_id, self.list_num_rand[self.leader_id])
-                print "New Leader was elected (id = %d)" %self.leader_id
+# ------------------------------------------------------------------------------------------------------
+    # A vessel answered a heartbeat: if it was found dead, it is a vessel again, and on the ring again
+    # (our neighbour if it is between us and our neighbour)
+    def vessel_answered(self, vessel_ip):
+        with mutex:
+            if vessel_ip in self.vessels and vessel_ip in self.list_node:
+                return
+            print "Vessel %s answers again" % vessel_ip
+            if vessel_ip not in self.vessels:
+                self.vessels.append(vessel_ip)
+            if vessel_ip not in self.list_node:
+                self.list_node.append(vessel_ip)
+            if vessel_ip in self.list_deads:
+                self.list_deads.remove(vessel_ip)
+            back = int(vessel_ip.split('.')[-1])
+            size = len(self.list_all)
+            # the ids come after ours around the ring, and ours last
+            if (back - self.vessel_id - 1) % size < (self.neighbour_id - self.vessel_id - 1) % size:
+                self.neighbour_id = back
+            self.max_id = max(self.max_id, back)
+
+# ------------------------------------------------------------------------------------------------------
+    # A vessel told us its leader and the round it was elected in (heartbeat, replication), and the random
+    # number of the leader if known: a leader of a newer round replaces ours, and if we were the leader we give up
+    def leader_learned(self, leader, leader_round, number=None):
+        with mutex:
+            # the random number of a vessel never changes, it is kept even for the leader we already know
+            if leader > 0 and number is not None:
+                self.list_num_rand[leader] = number
+            if leader <= 0 or leader == self.vessel_id or leader_round <= self.leader_round:
+                return
+            if leader_round >= self.election_round:
+                self.join_round(leader_round)
+            self.leader_id = leader
+            self.leader_round = leader_round
+            self.out_of_order.clear()
+            self.resync = True
+            print "Leader learned (id = %d, round %d)" % (leader, leader_round)
+        # the log of the leader goes on from its own sequence number, we start from its store
+        self.request_catch_up()
+
+# ------------------------------------------------------------------------------------------------------
+    # The failure detector found a vessel dead: the ring and the election are repaired by the sender workers,
+    # the checks and the heartbeats of the failure detector never wait for the other vessels
+    def vessel_suspected(self, vessel_ip):
+        print "Vessel %s suspected dead (no heartbeat)" % vessel_ip
+        self.sender.submit(self.vessel_failed, vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+    # A vessel found dead: the leader, our neighbour, or both (the ring first, the election goes on it)
+    def vessel_failed(self, vessel_ip):
+        if vessel_ip == "10.1.0.%d" % self.neighbour_id:
+            self.neighbour_failed(vessel_ip)
+        if vessel_ip == "10.1.0.%d" % self.leader_id:
+            self.leader_failed(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+    # We start a new round of the election with our random number as candidate (Chang-Roberts):
+    # a candidate only goes on around the ring while it is the best one met, the first one which comes back
+    # to its vessel is the best of all, then its elected token goes around the ring once
+    def start_election(self):
+        with mutex:
+            self.election_round += 1
+            self.participant = True
+            election = "%d:%d" % (self.election_round, self.list_num_rand[self.vessel_id])
+        self.sender.submit(self.propagate_value_to_neighbor, "/election", leader_elec, self.vessel_id, election)
+
+# ------------------------------------------------------------------------------------------------------
+    # The candidate (its id and its random number) of a round of the election, received from our neighbour
+    def election_candidate(self, candidate, election_round, number):
+        with mutex:
+            if election_round < self.election_round:
+                #a candidate of an old round, already over
+                return
+            if election_round > self.election_round:
+                #a new round, started by another vessel
+                self.join_round(election_round)
+            own = self.list_num_rand[self.vessel_id]
+            if candidate == self.vessel_id:
+                #our candidate went around the whole ring: we are the leader
+                self.leader_id = self.vessel_id
+                self.leader_round = self.election_round
+                self.participant = False
+                action, key, number = leader_elected, self.vessel_id, own
+                print "Leader was elected (id = %d)" %self.leader_id
+            elif (number, candidate) > (own, self.vessel_id):
+                #a better candidate than ours goes on (the highest id if the numbers are equal)
+                self.participant = True
+                action, key = leader_elec, candidate
+            elif not self.participant:
+                #our candidate is better, it replaces this one
+                self.participant = True
+                action, key, number = leader_elec, self.vessel_id, own
+            else:
+                #our candidate is better and already on the ring, this one stops here
+                return
+            election = "%d:%d" % (self.election_round, number)
+        self.sender.submit(self.propagate_value_to_neighbor, "/election", action, key, election)
+
+# ------------------------------------------------------------------------------------------------------
+    # We take part in a round of the election started by another vessel (called with the mutex)
+    # a leader which sees it was found dead by a vessel: it is not the leader anymore, it may be elected again
+    def join_round(self, election_round):
+        self.election_round = election_round
+        self.participant = False
+        if self.leader_id == self.vessel_id:
+            print "Leader %d steps down (round %d)" % (self.vessel_id, election_round)
+            self.leader_id = -1
+
+# ------------------------------------------------------------------------------------------------------
+    # The leader elected in a round of the election, received from our neighbour
+    def election_leader(self, leader, election_round, number):
+        with mutex:
+            if election_round < self.election_round or leader == self.vessel_id:
+                #an old round, or our elected token went around the whole ring: every vessel knows us
+                return
+            self.join_round(election_round)
+            self.leader_id = leader
+            self.leader_round = election_round
+            self.list_num_rand[leader] = number
+            #the operations waiting for a missing one came from the previous leader, we start from its store
+            self.out_of_order.clear()
+            self.resync = True
+            print "Leader was elected (id = %d)" %self.leader_id
+        self.sender.submit(self.propagate_value_to_neighbor, "/election", leader_elected, leader, "%d:%d" % (election_round, number))
+        # the log of the new leader goes on from its own sequence number
+        self.request_catch_up()
 
 # ------------------------------------------------------------------------------------------------------
     # We send a received value to all the neighbour's vessels
@@ -209,39 +1525,36 @@ class BlackboardServer(HTTPServer):
 
         #propagate the id and de random number to the neighbour
         check_connec = self.contact_vessel(vessel, path, action, key, value)
+        # just after our start, a neighbour which does not answer may not be started yet
+        while check_connec == False and vessel in self.list_node and time() < self.started / 1000.0 + ELECTION_STARTUP_TIMEOUT:
+            sleep(ELECTION_RETRY_INTERVAL)
+            check_connec = self.contact_vessel(vessel, path, action, key, value)
         if check_connec == False:
-            if vessel in self.list_node:
-                id_dead = self.neighbour_id
-                self.list_node.remove(vessel)
-                self.list_deads.append(vessel)
-                vessel_new ="10.1.0.%d" % self.neighbour_id
-
-                #if the neighbour is dead, discover the new neighbour id
-                while vessel_new not in self.list_node:
-                    if self.max_id == self.neighbour_id:
-                        self.max_id = self.vessel_id
-                        self.neighbour_id = 1
-                    else:
-                        self.neighbour_id += 1
-
-                    #address of the destination vessel
-                    vessel_new ="10.1.0.%d" % self.neighbour_id
-
-                #warns the new neighbour that
-                action1 = dead_neighbour
-                self.contact_vessel(vessel_new, path, action1, id_dead, self.max_id)
-                action2 = leader_elec
-
-                for i in self.list_num_rand.keys():
-                    if i in self.list_num_rand.keys():
-                        self.contact_vessel(vessel_new, path, action2, i, self.list_num_rand[i])
+            #the ring goes on without it (once, for the first message or heartbeat which found it dead)
+            self.neighbour_failed(vessel)
+            if vessel != "10.1.0.%d" % self.neighbour_id:
+                #the message (the token with the ids and the random numbers) goes to the new neighbour
+                self.propagate_value_to_neighbor(path, action, key, value)
 
 
-                #send the information about the ids and the random numbers to the new neighbour
-                self.propagate_value_to_neighbor(path, action, key, value)
+# ------------------------------------------------------------------------------------------------------
 
 
 # ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+# Serving engines
+# threads: every connection is handled by its own thread
+class ThreadedBlackboardServer(ThreadingMixIn, BlackboardServer):
+    # the persistent connections of the other vessels must not block each other
+    daemon_threads = True
+    # a thread can stay on a response and stream it (/board/events)
+    streaming = True
+
+# no select (single event loop) engine here: the requests wait for the group commit of the leader and for a
+# place in the sender queue, in a single event loop they would stop every other connection
+SERVING_ENGINES = {"threads": ThreadedBlackboardServer}
+# ------------------------------------------------------------------------------------------------------
+
 
 
 # ------------------------------------------------------------------------------------------------------
@@ -251,24 +1564,92 @@ class BlackboardServer(HTTPServer):
 # i.e. the store is accessible through self.server.store
 # Attributes of the server are SHARED accross all request hqndling/ threads!
 class BlackboardRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 lets the other vessels (and the browsers) reuse their connection for the next request
+    protocol_version = "HTTP/1.1"
+    # the headers are written one by one, without Nagle they are not delayed on a kept-alive socket
+    disable_nagle_algorithm = True
 # ------------------------------------------------------------------------------------------------------
     # We fill the HTTP headers
-    def set_HTTP_headers(self, status_code=200):
+    def set_HTTP_headers(self, status_code=200, length=0, content_type="text/html", etag=None, encoding=None):
         # We set the response status code (200 if OK, something else otherwise)
         self.send_response(status_code)
-        # We set the content type to HTML
-        self.send_header("Content-type", "text/html")
+        # We set the content type (HTML, except for the delta updates of the board)
+        self.send_header("Content-type", content_type)
+        # The length of the body is needed to keep the connection open after the response
+        # (no length: the body is sent in chunks, each with its length)
+        if length is None:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(length))
+        # The board is sent compressed (gzip, deflate) or not (identity), depending on the browser
+        if encoding is not None:
+            if encoding != 'identity':
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+        # The version of the page, the browser must ask with it (If-None-Match) before using its copy
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
         # No more important headers, we can close them
         self.end_headers()
 
+# ------------------------------------------------------------------------------------------------------
+    # The strong ETag of a version of the page (the versions restart with the server, not the ETags)
+    # (and of its encoding, a compressed page is not the same bytes)
+    def version_etag(self, version, encoding='identity'):
+        if encoding != 'identity':
+            return '"%d-%d-%s"' % (self.server.started, version, encoding)
+        return '"%d-%d"' % (self.server.started, version)
+
+# ------------------------------------------------------------------------------------------------------
+    # The compression of the board accepted by the browser (Accept-Encoding): gzip, deflate or identity
+    def accepted_encoding(self):
+        accept_encoding = self.headers.getheader('Accept-Encoding')
+        if accept_encoding is None:
+            return 'identity'
+        accepted = {}
+        for item in accept_encoding.split(','):
+            name, _, parameters = item.partition(';')
+            quality = 1.0
+            parameters = parameters.strip()
+            if parameters.startswith('q='):
+                try:
+                    quality = float(parameters[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[name.strip().lower()] = quality
+        for encoding in ('gzip', 'deflate'):
+            if accepted.get(encoding, 0.0) > 0.0:
+                return encoding
+        return 'identity'
+
+# ------------------------------------------------------------------------------------------------------
+    # We answer 304 (Not Modified), without body, if the browser already has this version of the page
+    def not_modified(self, etag):
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if etag not in tags and 'W/' + etag not in tags and '*' not in tags:
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return True
+
 # ------------------------------------------------------------------------------------------------------
     # a POST request must be parsed through urlparse.parse_QS, since the content is URL encoded
     def parse_POST_request(self):
         post_data = ""
         # We need to parse the response, so we must know the length of the content
         length = int(self.headers['Content-Length'])
-        # we can now parse the content using parse_qs
-        post_data = parse_qs(self.rfile.read(length), keep_blank_values=1)
+        post_content = self.rfile.read(length)
+        # the other vessels send binary messages, the browsers send URL encoded forms
+        if self.headers.getheader('Content-type') == BINARY_CONTENT_TYPE:
+            post_data = decode_messages(post_content)
+        else:
+            # we can now parse the content using parse_qs
+            post_data = parse_qs(post_content, keep_blank_values=1)
         # we return the data
         return post_data
 
@@ -279,56 +1660,236 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 # This function contains the logic executed when this server receives a GET request
 # This function is called AUTOMATICALLY upon reception and is executed as a thread!
     def do_GET(self):
+        if self.path == '/heartbeat':
+            # the failure detectors of the other vessels check that we are alive (too frequent to be printed)
+            # with our last sequence number, the vessels behind the leader ask for the operations they miss,
+            # and with our leader, its round and its random number, a vessel which missed an election learns
+            # the new leader
+            leader = self.server.leader_id
+            answer = "%d:%d:%d:%d" % (self.server.sequence, self.server.leader_round, leader,
+                                      self.server.list_num_rand.get(leader, -1))
+            self.set_HTTP_headers(200, len(answer), "text/plain")
+            self.wfile.write(answer)
+            return
         print("Receiving a GET on path %s" % self.path)
         # if path is /board, only the boardcontents template should be updated, else the whole page
-        if self.path == '/board':
-            self.update_board()
+        # (/board?since=N: only the changes of the board after the version N)
+        # (?offset=O&limit=N or ?from=K&to=K&limit=N: only a page of the board)
+        # /api/entries (a page of the entries in JSON) and /api/export (all of them, NDJSON) are for the tools
+        # /api/status (the depth of the outbound queues) is for the monitoring
+        path, _, query = self.path.partition('?')
+        arguments = parse_qs(query)
+        try:
+            since = int(arguments['since'][0]) if 'since' in arguments else None
+            page = self.page_arguments(arguments)
+        except ValueError:
+            self.send_error(400, "since, offset, limit, from and to must be numbers")
+            return
+        if path == '/board/events':
+            self.stream_board_events()
+        elif path == '/api/entries':
+            self.send_api_entries(page)
+        elif path == '/api/export':
+            self.send_api_export()
+        elif path == '/api/status':
+            self.send_api_status()
+        elif path == '/board':
+            if since is not None:
+                self.update_board_since(since)
+            elif page is not None:
+                self.update_board_page(page)
+            else:
+                self.update_board()
         else:
-            self.do_GET_Index()
+            self.do_GET_Index(page)
+
+# ------------------------------------------------------------------------------------------------------
+    # The page of the board asked: (offset, limit, from, to), None for the whole board
+    def page_arguments(self, arguments):
+        if not [name for name in ('offset', 'limit', 'from', 'to') if name in arguments]:
+            return None
+        offset = int(arguments['offset'][0]) if 'offset' in arguments else 0
+        limit = int(arguments['limit'][0]) if 'limit' in arguments else BOARD_PAGE_SIZE
+        first = int(arguments['from'][0]) if 'from' in arguments else None
+        last = int(arguments['to'][0]) if 'to' in arguments else None
+        if offset < 0 or limit <= 0:
+            raise ValueError("offset and limit out of range")
+        return (offset, limit, first, last)
 # ------------------------------------------------------------------------------------------------------
 # GET logic - specific path
 # ------------------------------------------------------------------------------------------------------
 
     def update_board(self):
-        self.set_HTTP_headers(200)
-        new_entry = ""
-        for i in self.server.store.keys(): #for every item in store
-            entry = entry_template % ("entries/" + str(i), i, self.server.store[i]) #create entries
-            new_entry += entry
-        newboard = boardcontents_template #put the new entries into the boardcontents
-        newboard = newboard[:-5]
-        newboard += '<p>'
-        newboard += new_entry
-        newboard += '</div>'
+        # the version is read before the board, the board sent is never older than its ETag
+        encoding = self.accepted_encoding()
+        etag = self.version_etag(self.server.version, encoding)
+        if self.not_modified(etag):
+            return
+        # the board is rendered (and compressed) again only if the store changed since the last request
+        self.send_board('', '', etag, encoding)
+
+# ------------------------------------------------------------------------------------------------------
+    # We send the board between head and tail: from the cache when it is current, with its length,
+    # else while it is rendered, in chunks (chunked transfer encoding), without waiting for the whole board
+    # compressed, it is sent from the cache of the compressed board, with its length
+    def send_board(self, head, tail, etag=None, encoding='identity'):
+        if encoding != 'identity':
+            body = self.server.compressed_board(head, tail, encoding)
+            self.set_HTTP_headers(200, len(body), etag=etag, encoding=encoding)
+            self.wfile.write(body)
+            return
+        chunks = self.server.cached_board()
+        if chunks is None and self.request_version != 'HTTP/1.1':
+            # there is no chunked transfer encoding before HTTP/1.1
+            chunks = list(self.server.render_board())
+        if chunks is not None:
+            # We set the response status code to 200 (OK) and the length of the page
+            self.set_HTTP_headers(200, len(head) + sum(len(chunk) for chunk in chunks) + len(tail), etag=etag, encoding=encoding)
+            self.wfile.write(head)
+            for chunk in chunks:
+                self.wfile.write(chunk)
+            self.wfile.write(tail)
+        else:
+            self.set_HTTP_headers(200, None, etag=etag, encoding=encoding)
+            self.write_chunked(chain([head], self.server.render_board(), [tail]))
+
+# ------------------------------------------------------------------------------------------------------
+    # We write the body in chunks as they come (chunked transfer encoding), each with its length
+    def write_chunked(self, chunks):
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        # the last chunk is empty
+        self.wfile.write("0\r\n\r\n")
+
+# ------------------------------------------------------------------------------------------------------
+    # Only a page of the board
+    def update_board_page(self, page):
+        # the version is read before the page, the page sent is never older than its ETag
+        etag = self.version_etag(self.server.version)
+        if self.not_modified(etag):
+            return
+        newboard = self.server.board_page(*page)
+        # We set the response status code to 200 (OK) and the length of the page
+        self.set_HTTP_headers(200, len(newboard), etag=etag)
         self.wfile.write(newboard)
 
+# ------------------------------------------------------------------------------------------------------
+    # Only the entries added, modified or deleted after a version of the board, in JSON
+    def update_board_since(self, since):
+        # the changes after a version are the same as long as the store does not change
+        etag = self.version_etag(self.server.version)
+        if self.not_modified(etag):
+            return
+        version, contents, entries = self.server.board_changes(since)
+        delta = self.board_delta(version, contents, entries)
+        self.set_HTTP_headers(200, len(delta), "application/json", etag)
+        self.wfile.write(delta)
 
 # ------------------------------------------------------------------------------------------------------
-    def do_GET_Index(self):
-        # We set the response status code to 200 (OK)
-        self.set_HTTP_headers(200)
-        # We should do some real HTML here
+    # A delta update of the board in JSON, the contents and the entries are sent as text
+    def board_delta(self, version, contents, entries):
+        if entries is not None:
+            entries = [(key, json_text(entry)) for key, entry in entries]
+        return json.dumps({'version': version, 'full': json_text(contents), 'entries': entries, 'renumber': False})
 
-        #write the leader id and his random number in the html file
-        leader_board = board_frontpage_header_template
-        aux = leader_board[-330:]
-        leader_board = leader_board[:-330]
-        leader_board += '</p>Leader id = %d; Random Number = %d</p>' %(self.server.leader_id, self.server.list_num_rand[self.server.leader_id] )
-        leader_board += aux
+# ------------------------------------------------------------------------------------------------------
+    # The machine API: a page of the entries in JSON (the first BOARD_PAGE_SIZE entries without page arguments)
+    def send_api_entries(self, page):
+        # the version is read before the page, the page sent is never older than its ETag
+        etag = self.version_etag(self.server.version)
+        if self.not_modified(etag):
+            return
+        if page is None:
+            page = (0, BOARD_PAGE_SIZE, None, None)
+        body = json.dumps(self.server.api_entries(*page))
+        self.set_HTTP_headers(200, len(body), "application/json", etag)
+        self.wfile.write(body)
+
+# ------------------------------------------------------------------------------------------------------
+    # The machine API: all the entries, one JSON line each (NDJSON), sent in chunks while they are serialized
+    def send_api_export(self):
+        chunks = self.server.export_entries()
+        if self.request_version != 'HTTP/1.1':
+            # there is no chunked transfer encoding before HTTP/1.1
+            chunks = list(chunks)
+            self.set_HTTP_headers(200, sum(len(chunk) for chunk in chunks), "application/x-ndjson")
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        else:
+            self.set_HTTP_headers(200, None, "application/x-ndjson")
+            self.write_chunked(chunks)
+
+# ------------------------------------------------------------------------------------------------------
+    # The machine API: the depth of the outbound queues, read at each request (never cached)
+    def send_api_status(self):
+        body = json.dumps(self.server.queue_status())
+        self.set_HTTP_headers(200, len(body), "application/json")
+        self.wfile.write(body)
+
+# ------------------------------------------------------------------------------------------------------
+    # The changes of the board pushed as they happen (server-sent events), each event is a delta update
+    # the response stays open until the browser leaves, so only with the threads serving engine
+    def stream_board_events(self):
+        if not self.server.streaming:
+            self.send_error(501, "Board events need the threads serving engine")
+            return
+        # the subscriber receives the changes from now on, the first event is the whole board
+        subscriber = self.server.board_events.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            # the end of the events is the end of the connection
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = 1
+            overflow, changes = True, []
+            while True:
+                if overflow:
+                    version, contents, entries = self.server.board_changes(-1)
+                elif changes:
+                    version = changes[-1][0]
+                    contents = None
+                    entries = [(key, self.server.board_entry(key)) for key in sorted(set(key for v, key in changes))]
+                else:
+                    # nothing changed, we check that the browser is still there
+                    self.wfile.write(": keep-alive\n\n")
+                    overflow, changes = subscriber.pop(EVENTS_KEEPALIVE)
+                    continue
+                delta = self.board_delta(version, contents, entries)
+                self.wfile.write("data: %s\n\n" % delta)
+                overflow, changes = subscriber.pop(EVENTS_KEEPALIVE)
+        except socket.error:
+            # the browser left, what could not be sent is dropped (not sent again when the handler ends)
+            self.wfile = StringIO()
+        finally:
+            self.server.board_events.unsubscribe(subscriber)
 
-        html_reponse = leader_board + boardcontents_template + board_frontpage_footer_template
-        new_entry = ""
 
-        for i in self.server.store.keys(): #for each item in store, create entries
-            entry = entry_template % ("entries/" + str(i), i, self.server.store[i])
-            new_entry += entry
-        boardcontents_template2 = boardcontents_template[:-5] #put the new entries into the boardcontents
-        boardcontents_template2 += '<p>'
-        boardcontents_template2 += new_entry
-        boardcontents_template2 += '</div>'
-        html_reponse = leader_board + boardcontents_template2 + board_frontpage_footer_template
+# ------------------------------------------------------------------------------------------------------
+    def do_GET_Index(self, page=None):
+        # We should do some real HTML here
 
-        self.wfile.write(html_reponse)
+        #write the leader id and his random number in the leader slot of the html file
+        #(during an election, or before the number of the leader is known, there is no leader to show)
+        leader_id = self.server.leader_id
+        number = self.server.list_num_rand.get(leader_id)
+        if leader_id > 0 and number is not None:
+            leader = '</p>Leader id = %d; Random Number = %d</p>' % (leader_id, number)
+        else:
+            leader = '</p>No leader yet</p>'
+        leader_board = board_frontpage_header_compiled.fill(leader=leader)
+
+        if page is None:
+            # the entries in the boardcontents, the page is never copied whole
+            self.send_board(leader_board, board_frontpage_footer_template, encoding=self.accepted_encoding())
+        else:
+            # only the entries of a page of the board
+            html_reponse = leader_board + self.server.board_page(*page) + board_frontpage_footer_template
+            # We set the response status code to 200 (OK) and the length of the page
+            self.set_HTTP_headers(200, len(html_reponse))
+            self.wfile.write(html_reponse)
 
 # ------------------------------------------------------------------------------------------------------
 
@@ -342,7 +1903,21 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
         # We should also parse the data received
         # and set the headers for the client
 
-        if self.server.vessel_id == self.server.leader_id:
+        if self.path == "/replication":
+            #batch of updates from the leader
+            post_data = self.parse_POST_request()
+            self.set_HTTP_headers(200)
+            self.server.apply_replicated_batch(post_data)
+
+        elif self.path == "/replication/catchup":
+            #a vessel asks the leader for the operations it misses
+            self.send_catch_up()
+
+        elif self.path == "/election":
+            #election messages between neighbours, the leader too can receive them
+            self.act_in_election()
+
+        elif self.server.vessel_id == self.server.leader_id:
             #leader - act like a leader
             self.act_like_a_leader()
 
@@ -363,14 +1938,13 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
             if 'action' in post_data:
             # new entry from the other normal vessels
                 if ''.join(post_data['action']) == add_leader:
-                    self.server.add_value_to_store_leader(''.join(post_data['value']))
                     entry = ''.join(post_data['value'])
             else:
             # submit information write by the own leader vessel
-                self.server.add_value_to_store_leader(post_data['entry'])
                 entry = ''.join(post_data['entry'])
 
-            key = self.server.current_key
+            # the key is given when the entry is committed
+            key = None
             action = add_vessels
 
 
@@ -381,13 +1955,11 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 
             if id_mod_del == 0:
                 # modify
-                self.server.modify_value_in_store(key, post_data['entry'])
                 entry = ''.join(post_data['entry'])
                 action = mod_vessels
 
             elif id_mod_del == 1:
                 # delete
-                self.server.delete_value_in_store(key)
                 entry = None
                 action = del_vessels
 
@@ -400,20 +1972,15 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
             # update value
                 action = mod_vessels
                 entry = ''.join(post_data['value'])
-                self.server.modify_value_in_store(key, post_data['value'])
 
             elif ''.join(post_data['action']) == del_leader:
             # delete value
                 action = del_vessels
                 entry = None
-                self.server.delete_value_in_store(key)
 
         #we want to retransmit to all the all non-leader (normal) vessels all the tasks done in the leader
-        thread = Thread(target=self.server.propagate_value_to_vessels, args=(self.path, action, key, entry))
-        #We kill the process if we kill the server
-        thread.daemon = True
-        # We start the thread
-        thread.start()
+        #the task is done and logged with the tasks of the other requests (group commit)
+        self.server.group_commit.submit((self.path, action, key, entry))
 
 
 # ------------------------------------------------------------------------------------------------------
@@ -471,79 +2038,55 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
                 # delete value
                 self.server.delete_value_in_store(key)
 
-            elif ''.join(post_data['action']) == dead_neighbour:
-                #some is reporting that one vessel died during the leader election
-                id_dead = key
-                self.max_id = int(''.join(post_data['value']) )
-
-                vessel_dead = "10.1.0.%d" % (id_dead)
-                if vessel_dead in self.server.list_node:
-                    self.server.list_node.remove(vessel_dead)
-                    self.server.list_deads.append(vessel_dead)
-
-                    action = dead_neighbour
-                    t_send_dead = Thread(target=self.server.propagate_value_to_neighbor, args=( None, action, id_dead, self.max_id))
-                    t_send_dead.daemon = True
-                    t_send_dead.start()
-
-
-            elif ''.join(post_data['action']) == leader_elec:
-                #random number of my neighbour
-                num_rec = int( ''.join( post_data['value']) )
-                id_rec = key
-
-                if id_rec not in self.server.list_num_rand.keys():
-                    action = leader_elec
-                    self.server.list_num_rand[id_rec] = num_rec
-                    if self.server.vessel_id != id_rec:
-                        t_send = Thread(target=self.server.propagate_value_to_neighbor, args=( None, action, id_rec, num_rec))
-                        t_send.daemon = True
-                        t_send.start()
-
-                num_nodes_begin = len(self.server.list_node) + len(self.server.list_deads)
-                if  num_nodes_begin == len(self.server.list_num_rand):
-                    if self.server.leader_id == -1:
-                        self.server.leader_id = 0
-                        thread = Thread(target=self.select_leader)
-                        thread.daemon = True
-                        thread.start()
-
-
-            elif ''.join(post_data['action']) == new_leader:
-                #leader is dead
-                vessel = "10.1.0.%s" % self.server.leader_id
-                self.server.vessels.remove(vessel)
-                if self.server.leader_id in self.server.list_num_rand.keys():
-                    del self.server.list_num_rand[self.server.leader_id]
-
-                self.server.leader_id = key
-                print "New Leader was elected (id = %d)" %self.server.leader_id
-
 
 
         if retransmit_to_leader:
             retransmit_to_leader = False
 
-            thread = Thread(target=self.server.propagate_value_to_leader, args=(self.path, action, key, ''.join(post_data['entry'])))
-            thread.daemon = True
-            thread.start()
+            self.server.sender.submit(self.server.propagate_value_to_leader, self.path, action, key, ''.join(post_data['entry']))
 
 # ------------------------------------------------------------------------------------------------------
-    def select_leader(self):
-        #wainting to finish to receive all the communications
-        sleep(15)
+# Replication log
+    def send_catch_up(self):
 
-        for addr_dead in self.server.list_deads:
-            if addr_dead[-2] == '.' :
-                id_dead = int(addr_dead[-1])
-            else:
-                id_dead = int(addr_dead[-2:])
+        post_data = self.parse_POST_request()
+        #the operations of the log from the first one the vessel misses (none if we are not the leader anymore)
+        first = int(''.join(post_data['from']))
+        messages = []
+        if self.server.leader_id == self.server.vessel_id:
+            messages = self.server.leader_messages(self.server.replication_since(first))
+        answer = encode_messages(REPLICATION_FIELDS, messages)
+        self.set_HTTP_headers(200, len(answer), BINARY_CONTENT_TYPE)
+        self.wfile.write(answer)
 
-            if id_dead in self.server.list_num_rand.keys():
-                del self.server.list_num_rand[id_dead]
+# ------------------------------------------------------------------------------------------------------
+# Election
+    def act_in_election(self):
 
-        self.server.leader_id = max(self.server.list_num_rand, key = self.server.list_num_rand.get)
-        print "Leader was elected (id = %d)" %self.server.leader_id
+        post_data = self.parse_POST_request()
+        self.set_HTTP_headers(200)
+        key = int(''.join(post_data['key']))
+
+        if ''.join(post_data['action']) == dead_neighbour:
+            #some is reporting that one vessel died during the leader election
+            id_dead = key
+            self.max_id = int(''.join(post_data['value']) )
+
+            vessel_dead = "10.1.0.%d" % (id_dead)
+            if vessel_dead in self.server.list_node:
+                self.server.list_node.remove(vessel_dead)
+                self.server.list_deads.append(vessel_dead)
+
+                action = dead_neighbour
+                self.server.sender.submit(self.server.propagate_value_to_neighbor, "/election", action, id_dead, self.max_id)
+
+        elif ''.join(post_data['action']) in (leader_elec, leader_elected):
+            #the candidate or the leader key, with the round of the election and its random number
+            election_round, number = [int(i) for i in ''.join(post_data['value']).split(':')]
+            if ''.join(post_data['action']) == leader_elec:
+                self.server.election_candidate(key, election_round, number)
+            else:
+                self.server.election_leader(key, election_round, number)
 
 
 
@@ -551,12 +2094,12 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 
 # ------------------------------------------------------------------------------------------------------
 #Leader election algorithm - we choose the leader
+# every vessel starts the first round with its random number, only the best candidate goes around the
+# whole ring: O(n log n) messages on average, then n for the elected token (the neighbours which are
+# still starting are waited for by the propagation)
 def leader_election(server, my_id):
 
     num_rand = randint(0, PORT_NUMBER)
-    action = leader_elec
-    #wait for the initialization of all vessels
-    sleep(1)
 
     if len(server.vessels) == (server.vessel_id):
     #node with the highest id - his neighbour is the node id = 1
@@ -565,11 +2108,9 @@ def leader_election(server, my_id):
     #all the other nodes
         server.neighbour_id = server.vessel_id + 1
 
-    server.list_num_rand[vessel_id] = num_rand
+    server.list_num_rand[my_id] = num_rand
 
-    t_send = Thread(target=server.propagate_value_to_neighbor, args=( None, action, my_id, num_rand))
-    t_send.daemon = True
-    t_send.start()
+    server.start_election()
 
 
 # ------------------------------------------------------------------------------------------------------
@@ -582,20 +2123,27 @@ if __name__ == '__main__':
     vessel_list = []
     vessel_id = 0
 
+    serving_engine = SERVING_ENGINE
     # Checking the arguments
-    if len(sys.argv) != 3:  # 2 args, the script and the vessel name
-        print("Arguments: vessel_ID number_of_vessels")
+    # 2 args, the script and the vessel name, and optionally the serving engine
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] not in SERVING_ENGINES):
+        print("Arguments: vessel_ID number_of_vessels [threads]")
+        # no server is started on wrong arguments (as the select engine, which this lab refuses)
+        sys.exit(1)
     else:
         # We need to know the vessel IP
         vessel_id = int(sys.argv[1])
         # We need to write the other vessels IP, based on the knowledge of their number
         for i in range(1, int(sys.argv[2]) + 1):
             vessel_list.append("10.1.0.%d" % i)  # We can add ourselves, we have a test in the propagation
+        # The serving engine can be chosen as third argument
+        if len(sys.argv) == 4:
+            serving_engine = sys.argv[3]
 
 
     # We launch a server
-    server = BlackboardServer(('', PORT_NUMBER), BlackboardRequestHandler, vessel_id, vessel_list)
-    print("Starting the server on port %d" % PORT_NUMBER)
+    server = SERVING_ENGINES[serving_engine](('', PORT_NUMBER), BlackboardRequestHandler, vessel_id, vessel_list)
+    print("Starting the server on port %d (%s engine)" % (PORT_NUMBER, serving_engine))
 
     server.max_id = int(sys.argv[2])
     leader_election(server, vessel_id)
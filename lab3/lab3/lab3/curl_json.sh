@@ -0,0 +1,7 @@
+# An entry which is not UTF-8 (caf\xe9 in latin-1): the JSON of the board and of the API must still be valid
+set -e
+curl -d 'entry=caf%E9' -X 'POST' 'http://10.1.0.1:8080/board'
+curl -s 'http://10.1.0.1:8080/board?since=0' | python -m json.tool > /dev/null
+curl -s 'http://10.1.0.1:8080/api/entries' | python -m json.tool
+curl -s 'http://10.1.0.1:8080/api/export' | python -c 'import sys, json; print [json.loads(line) for line in sys.stdin]'
+echo "JSON OK"
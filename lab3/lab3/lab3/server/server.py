@@ -9,15 +9,27 @@
 #       Import various libraries
 # -----------------------------------------------------------------------------------------------------
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # Socket specifically designed to handle HTTP requests
+from SocketServer import ThreadingMixIn  # Handle each connection in its own thread
 import sys  # Retrieve arguments
 from urlparse import parse_qs  # Parse POST data
+import json  # Delta updates of the board
+import zlib  # Compression of the board (gzip, deflate)
 from httplib import HTTPConnection  # Create a HTTP connection, as a client (for POST requests to the other vessels)
 from urllib import urlencode  # Encode POST content into the HTTP header
 from codecs import open  # Open a file
-from threading import Thread, Lock  # Thread Management
+from struct import pack, unpack_from, calcsize  # Binary messages between vessels
+from Queue import Queue, Full  # Thread-safe queue
+from itertools import chain  # Chunks of the board between the head and the tail of the page
+from collections import deque  # FIFO of messages
+from select import select, error as select_error  # Wait for the sockets (event loop, idle connections)
+from errno import EINTR, EAGAIN, EWOULDBLOCK  # Errors of non-blocking sockets
+from cStringIO import StringIO  # Requests and responses in memory (event loop)
+from types import InstanceType  # Request handler of the event loop
+import socket  # Socket errors
+from threading import Thread, Lock, RLock, Condition  # Thread Management
+import re  # Slots of the templates
 from time import sleep, time
-from operator import attrgetter
-from threading import Lock
+from bisect import bisect_left, bisect_right, insort  # Sorted list of the unique ids
 # ------------------------------------------------------------------------------------------------------
 
 
@@ -41,6 +53,57 @@ update_id = "update_new_id"                                 #
 
 
 
+# ------------------------------------------------------------------------------------------------------
+#       Templates compiled once
+# ------------------------------------------------------------------------------------------------------
+# A template is split once into its static segments and the slots between them: %s and %d in their order
+# (as for the % operator), and the named slots <!-- slot:name --> (leader, entries, ...)
+TEMPLATE_SLOT = re.compile(r'%([sd%])|<!-- slot:(\w+) -->')
+
+class Template:
+# ------------------------------------------------------------------------------------------------------
+    def __init__(self, text):
+        # the static text around the slots (one more segment than slots)
+        self.segments = []
+        # the slots: their position for %s and %d, their name for the named slots
+        self.slots = []
+        formats = []
+        segment = ''
+        position = 0
+        for match in TEMPLATE_SLOT.finditer(text):
+            segment += text[position:match.start()]
+            position = match.end()
+            if match.group(1) == '%':
+                segment += '%'
+                continue
+            self.segments.append(segment)
+            formats.append(segment.replace('%', '%%'))
+            if match.group(1) is not None:
+                self.slots.append(len(self.slots))
+                formats.append('%' + match.group(1))
+            else:
+                self.slots.append(match.group(2))
+                formats.append('%s')
+            segment = ''
+        segment += text[position:]
+        self.segments.append(segment)
+        formats.append(segment.replace('%', '%%'))
+        # the segments and the slots are filled by a single formatting
+        self.format = ''.join(formats)
+
+# ------------------------------------------------------------------------------------------------------
+    # The template filled with the values of its slots, in their order
+    def render(self, *values):
+        return self.format % values
+
+# ------------------------------------------------------------------------------------------------------
+    # The template filled with the values of its named slots (empty when not given)
+    def fill(self, **values):
+        return self.format % tuple([values.get(slot, '') for slot in self.slots])
+
+# ------------------------------------------------------------------------------------------------------
+
+
 # ------------------------------------------------------------------------------------------------------
 #       Global variables for HTML templates
 # ------------------------------------------------------------------------------------------------------
@@ -49,6 +112,9 @@ try:
     board_frontpage_header_template = open('server/board_frontpage_header_template.html', 'r').read()
     boardcontents_template = open('server/boardcontents_template.html', 'r').read()
     entry_template = open('server/entry_template.html', 'r').read()
+    # the templates filled at each request are compiled once
+    boardcontents_compiled = Template(boardcontents_template)
+    entry_compiled = Template(entry_template)
 except Exception as e:
     print(e)
 # ------------------------------------------------------------------------------------------------------
@@ -58,6 +124,41 @@ except Exception as e:
 #       Static variables definitions
 # ------------------------------------------------------------------------------------------------------
 PORT_NUMBER = 8080
+# Serving engine used when none is given on the command line: threads or select
+SERVING_ENGINE = "threads"
+# Number of vessels contacted in parallel when a message is propagated
+FANOUT_PARALLELISM = 8
+# Content type of the binary messages between vessels
+BINARY_CONTENT_TYPE = "application/x-vessel-messages"
+# Workers of the sender queue (propagating only queues the messages in the fan-out,
+# so one worker is enough and keeps them in the order of the requests)
+SENDER_WORKERS = 1
+# Maximum number of works waiting in the sender queue
+SENDER_QUEUE_SIZE = 1000
+# When the sender queue is full, the request waits (True) or its propagation is rejected (False)
+SENDER_QUEUE_BLOCK = True
+# Maximum number of replication messages sent to a vessel in one batch
+BATCH_SIZE = 64
+# Time (in seconds) a replication message waits for others before its batch is sent
+BATCH_WINDOW = 0.01
+# Time (in seconds) a modify or a delete received before its post waits for it, before being dropped
+PENDING_TIMEOUT = 60
+# Number of deleted posts remembered, the modifies and deletes arriving after the delete of their post are dropped
+DELETED_KEPT = 10000
+# Bits of the unique id of a post holding the vessel id (up to 65536 vessels), the others hold the Lamport clock
+VESSEL_ID_BITS = 16
+# Number of changes of the store kept for the delta updates of the board (/board?since=N)
+CHANGES_KEPT = 1000
+# Changes kept for a subscriber of /board/events before it gets the whole board again
+EVENTS_BUFFER_SIZE = 100
+# Time (in seconds) after which an idle stream of board events is checked with a comment
+EVENTS_KEEPALIVE = 15
+# Entries of the board rendered and sent together when the board is streamed
+STREAM_CHUNK_ENTRIES = 100
+# Entries in a page of the board (/?offset=O&limit=N or /?from=K&to=K&limit=N), when no limit is given
+BOARD_PAGE_SIZE = 100
+# Level of the compression of the board for the browsers accepting it (1 fastest - 9 smallest)
+COMPRESSION_LEVEL = 6
 
 # ------------------------------------------------------------------------------------------------------
 
@@ -74,24 +175,643 @@ global num_messages
 # ------------------------------------------------------------------------------------------------------
 #       Locks
 # ------------------------------------------------------------------------------------------------------
-mutex = Lock()
-mutex_list = Lock()
+# the store is shared by the request handling threads and the reconciliation thread
+mutex = RLock()
 # ------------------------------------------------------------------------------------------------------
 
 
 # ------------------------------------------------------------------------------------------------------
 #       Class of a message
 # ------------------------------------------------------------------------------------------------------
-class Message:
-    def __init__(self, uniqueid, message, idi):
+# We keep large boards in memory: a message is a slotted object (no __dict__ for each entry),
+# the same text posted several times is shared (interned), and its position on the board is
+# its position in the store (no seq. number kept in the message)
+class Message(object):
+    __slots__ = ('uniqueid', 'message')
+
+    def __init__(self, uniqueid, message):
         #unique id - doesn't change during all the execution
         self.uniqueid = uniqueid
         #data post
-        self.message = message
-        #seq. number
-        self.id = idi
-        #store action in the waiting actions list
-        self.action = None
+        self.message = intern(message)
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Unique id of a post - (Lamport clock, vessel id)
+# ------------------------------------------------------------------------------------------------------
+# We pack the pair in one integer, the clock in the high bits, the vessel id in the VESSEL_ID_BITS low bits
+def make_unique_id(clock, vessel_id):
+    return (clock << VESSEL_ID_BITS) | vessel_id
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Class of the store - messages ordered by unique id
+# ------------------------------------------------------------------------------------------------------
+# We keep the unique ids sorted, each message inserted at its place when it arrives,
+# so the position of a message on the board is its position in the list (no sort, no renumbering)
+# and we find the messages by their unique id through a dict
+class OrderedStore:
+    def __init__(self):
+        # sorted list of the unique ids
+        self.keys = []
+        # unique id -> message
+        self.messages = {}
+
+    # We insert a message at its place, once (False if the unique id is already on the board)
+    def add(self, message):
+        if message.uniqueid in self.messages:
+            return False
+        insort(self.keys, message.uniqueid)
+        self.messages[message.uniqueid] = message
+        return True
+
+    # We find a message by its unique id (None if it is not on the board)
+    def get(self, uniqueid):
+        return self.messages.get(uniqueid)
+
+    # We remove a message by its unique id and return it (None if it is not on the board)
+    def remove(self, uniqueid):
+        message = self.messages.pop(uniqueid, None)
+        if message is not None:
+            del self.keys[bisect_left(self.keys, uniqueid)]
+        return message
+
+    def __len__(self):
+        return len(self.keys)
+
+    # The messages in the order of the board
+    def __iter__(self):
+        messages = self.messages
+        for key in self.keys:
+            yield messages[key]
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Binary format of the messages between vessels (POST on /replication)
+# ------------------------------------------------------------------------------------------------------
+# header:  number of fields (unsigned short), number of messages (unsigned int)
+#          then the name of every field: length (unsigned char) + bytes
+# message: the length of every field (unsigned int each, one struct), then the raw bytes of the fields
+# Decoding gives the same {field: [value of message 1, value of message 2, ...]} as parse_qs
+def encode_messages(fields, messages):
+    parts = [pack("!HI", len(fields), len(messages))]
+    for field in fields:
+        parts.append(pack("!B", len(field)))
+        parts.append(field)
+    lengths_format = "!%dI" % len(fields)
+    for message in messages:
+        # the values are sent as strings, like urlencode does
+        values = [str(value) for value in message]
+        parts.append(pack(lengths_format, *[len(value) for value in values]))
+        parts.extend(values)
+    return "".join(parts)
+
+
+def decode_messages(data):
+    number_fields, number_messages = unpack_from("!HI", data, 0)
+    offset = calcsize("!HI")
+    fields = []
+    for i in range(0, number_fields):
+        length = ord(data[offset])
+        fields.append(data[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    lengths_format = "!%dI" % number_fields
+    lengths_size = calcsize(lengths_format)
+    decoded = dict((field, []) for field in fields)
+    for i in range(0, number_messages):
+        lengths = unpack_from(lengths_format, data, offset)
+        offset += lengths_size
+        for field, length in zip(fields, lengths):
+            decoded[field].append(data[offset:offset + length])
+            offset += length
+    # a truncated content would give cut values
+    if offset != len(data):
+        raise ValueError("Malformed messages: %d bytes expected, %d received" % (offset, len(data)))
+    return decoded
+
+
+# Text of the entries (and of the board) in JSON: they are stored as the bytes posted and json only takes UTF-8,
+# so the invalid bytes are replaced (U+FFFD) instead of failing the whole response
+def json_text(text):
+    if text is None:
+        return None
+    return text.decode('utf-8', 'replace')
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Pool of persistent (keep-alive) connections to the other vessels
+# ------------------------------------------------------------------------------------------------------
+# Each vessel IP has at most max_per_vessel sockets open, an idle socket is reused by the next message
+# instead of paying a new TCP handshake, and a socket that looks closed or broken is replaced by a new one
+class VesselConnectionPool:
+# ------------------------------------------------------------------------------------------------------
+    def __init__(self, port, max_per_vessel=4, timeout=30, max_idle=30):
+        # port used by every vessel
+        self.port = port
+        # maximum number of sockets (idle and busy) towards one vessel
+        self.max_per_vessel = max_per_vessel
+        # timeout of a request, after which the connection fails if nothing happened
+        self.timeout = timeout
+        # an idle socket older than this (in seconds) is closed instead of reused
+        self.max_idle = max_idle
+        # idle connections of each vessel: vessel_ip -> [(connection, last time used), ...]
+        self.idle = {}
+        # number of sockets currently opened towards each vessel: vessel_ip -> int
+        self.opened = {}
+        # protects idle and opened, and wakes up the threads waiting for a free socket
+        self.condition = Condition(Lock())
+
+# ------------------------------------------------------------------------------------------------------
+    # An idle connection is healthy if it is not too old and the vessel did not close it meanwhile
+    def is_healthy(self, connection, last_used):
+        if time() - last_used > self.max_idle:
+            return False
+        # not connected yet, it will connect on the next request
+        if connection.sock is None:
+            return True
+        try:
+            readable = select([connection.sock], [], [], 0)[0]
+        except Exception:
+            return False
+        # nothing should be readable on an idle keep-alive socket, otherwise the vessel closed it
+        return not readable
+
+# ------------------------------------------------------------------------------------------------------
+    # Take a connection towards vessel_ip, waiting if all of its sockets are busy
+    def acquire(self, vessel_ip):
+        with self.condition:
+            while True:
+                idle = self.idle.setdefault(vessel_ip, [])
+                # we reuse the most recently used connection first
+                while idle:
+                    connection, last_used = idle.pop()
+                    if self.is_healthy(connection, last_used):
+                        return connection
+                    connection.close()
+                    self.opened[vessel_ip] -= 1
+                # we can still open a new socket towards this vessel
+                if self.opened.get(vessel_ip, 0) < self.max_per_vessel:
+                    self.opened[vessel_ip] = self.opened.get(vessel_ip, 0) + 1
+                    break
+                self.condition.wait()
+        # We contact vessel:port since we all use the same port
+        return HTTPConnection("%s:%d" % (vessel_ip, self.port), timeout=self.timeout)
+
+# ------------------------------------------------------------------------------------------------------
+    # Give back a connection, it is kept open only if it can be used again
+    def release(self, vessel_ip, connection, reusable):
+        with self.condition:
+            if reusable:
+                self.idle[vessel_ip].append((connection, time()))
+            else:
+                connection.close()
+                self.opened[vessel_ip] -= 1
+            self.condition.notify()
+
+# ------------------------------------------------------------------------------------------------------
+    # Send a POST request to vessel_ip and return the HTTP status of the response
+    def post(self, vessel_ip, path, body, headers):
+        while True:
+            connection = self.acquire(vessel_ip)
+            # a reused socket may have been closed by the vessel since the health check
+            reused = connection.sock is not None
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                # the body must be read before the socket can carry the next request
+                response.read()
+            except socket.timeout:
+                # the vessel did not answer, we do not send the message twice
+                self.release(vessel_ip, connection, False)
+                raise
+            except Exception:
+                self.release(vessel_ip, connection, False)
+                if not reused:
+                    raise
+                # we try again on another socket
+                continue
+            self.release(vessel_ip, connection, not response.will_close)
+            return response.status
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Fan-out of the messages sent to the other vessels
+# ------------------------------------------------------------------------------------------------------
+# Every vessel has its own FIFO queue of messages, and a fixed number of workers send them in parallel.
+# A vessel is handled by one worker at a time, so its messages keep their order, and a slow or dead
+# vessel only keeps one worker busy while the other vessels are still served by the rest of them
+class VesselFanout:
+# ------------------------------------------------------------------------------------------------------
+    def __init__(self, parallelism):
+        # pending messages of each vessel: vessel_ip -> deque([(function, args), ...])
+        self.queues = {}
+        # vessels with pending messages and no worker on them
+        self.ready = Queue()
+        # protects the queues of the vessels
+        self.lock = Lock()
+        # the workers are started once and live as long as the server
+        for i in range(0, parallelism):
+            worker = Thread(target=self.work)
+            # We kill the process if we kill the server
+            worker.daemon = True
+            worker.start()
+
+# ------------------------------------------------------------------------------------------------------
+    # Queue a message for vessel_ip, function(*args) is called by a worker to send it
+    def send(self, vessel_ip, function, *args):
+        with self.lock:
+            queue = self.queues.setdefault(vessel_ip, deque())
+            queue.append((function, args))
+            # a vessel with older pending messages is already known by the workers
+            if len(queue) == 1:
+                self.ready.put(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+    # Number of messages waiting for each vessel
+    def pending(self):
+        with self.lock:
+            return dict((vessel_ip, len(queue)) for vessel_ip, queue in self.queues.items())
+
+# ------------------------------------------------------------------------------------------------------
+    # Loop of a worker: send the oldest message of a ready vessel
+    def work(self):
+        while True:
+            vessel_ip = self.ready.get()
+            with self.lock:
+                function, args = self.queues[vessel_ip][0]
+            try:
+                function(*args)
+            except Exception as e:
+                print "Error while sending to %s" % vessel_ip
+                print(e)
+            with self.lock:
+                queue = self.queues[vessel_ip]
+                queue.popleft()
+                # the vessel goes back in the ready queue, after the other ready vessels
+                if len(queue) > 0:
+                    self.ready.put(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Batches of replication messages
+# ------------------------------------------------------------------------------------------------------
+# The messages for a vessel are collected during a short window (or until the batch is full) and are
+# then sent together as one batch, through the fan-out so the batches of a vessel keep their order
+class ReplicationBatcher:
+# ------------------------------------------------------------------------------------------------------
+    def __init__(self, fanout, send_batch, size, window):
+        # the fan-out sending the batches
+        self.fanout = fanout
+        # send_batch(vessel_ip, messages) sends one batch to a vessel
+        self.send_batch = send_batch
+        # maximum number of messages in a batch
+        self.size = size
+        # time (in seconds) a message may wait for other messages
+        self.window = window
+        # messages collected for each vessel: vessel_ip -> [message, ...]
+        self.batches = {}
+        # protects the batches, and wakes up the flusher when a message arrives
+        self.condition = Condition(Lock())
+        flusher = Thread(target=self.run)
+        # We kill the process if we kill the server
+        flusher.daemon = True
+        flusher.start()
+
+# ------------------------------------------------------------------------------------------------------
+    # Add a message to the batch of vessel_ip
+    def add(self, vessel_ip, message):
+        with self.condition:
+            batch = self.batches.setdefault(vessel_ip, [])
+            batch.append(message)
+            if len(batch) >= self.size:
+                self.flush_vessel(vessel_ip)
+            else:
+                self.condition.notify()
+
+# ------------------------------------------------------------------------------------------------------
+    # Hand the batch of vessel_ip to the fan-out (the condition must be held)
+    def flush_vessel(self, vessel_ip):
+        batch = self.batches.pop(vessel_ip, None)
+        if batch:
+            self.fanout.send(vessel_ip, self.send_batch, vessel_ip, batch)
+
+# ------------------------------------------------------------------------------------------------------
+    # Loop of the flusher: the first message of a window starts it, all the batches are sent at its end
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.batches:
+                    self.condition.wait()
+            sleep(self.window)
+            with self.condition:
+                for vessel_ip in self.batches.keys():
+                    self.flush_vessel(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Outbound sender queue
+# ------------------------------------------------------------------------------------------------------
+# The propagation work of the requests goes into one bounded queue drained by a fixed set of workers,
+# instead of a new thread per request. When the queue is full the caller waits, or its work is rejected
+class SenderQueue:
+# ------------------------------------------------------------------------------------------------------
+    def __init__(self, workers, size, block):
+        # pending work: (function, args)
+        self.queue = Queue(size)
+        # wait for a free place when the queue is full, or reject the work
+        self.block = block
+        # the workers are started once and live as long as the server
+        for i in range(0, workers):
+            worker = Thread(target=self.work)
+            # We kill the process if we kill the server
+            worker.daemon = True
+            worker.start()
+
+# ------------------------------------------------------------------------------------------------------
+    # Queue function(*args), we return False if it was rejected because the queue is full
+    def submit(self, function, *args):
+        if self.block and self.full():
+            print "Sender queue full (%d waiting), %s waits" % (self.depth(), function.__name__)
+        try:
+            self.queue.put((function, args), self.block)
+        except Full:
+            print "Sender queue full (%d waiting), %s rejected" % (self.depth(), function.__name__)
+            return False
+        return True
+
+# ------------------------------------------------------------------------------------------------------
+    # The queue is full: a work submitted now waits for a place, or is rejected
+    def full(self):
+        return self.queue.full()
+
+# ------------------------------------------------------------------------------------------------------
+    # Number of works waiting in the queue
+    def depth(self):
+        return self.queue.qsize()
+
+# ------------------------------------------------------------------------------------------------------
+    # Loop of a worker
+    def work(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                print "Error in %s" % function.__name__
+                print(e)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Subscribers of the board events (/board/events)
+# ------------------------------------------------------------------------------------------------------
+# Each subscriber has its own bounded buffer of changes: a slow browser never holds the store, when
+# its buffer is full the changes are dropped and it gets the whole board again
+class BoardSubscriber:
+# ------------------------------------------------------------------------------------------------------
+    def __init__(self, size):
+        # changes not sent yet: (version, key)
+        self.changes = deque()
+        # maximum number of changes in the buffer
+        self.size = size
+        # changes were dropped, the whole board must be sent
+        self.overflow = False
+        # protects the buffer, and wakes up the stream when a change arrives
+        self.condition = Condition(Lock())
+
+# ------------------------------------------------------------------------------------------------------
+    # A change of the store (called by the thread changing the store)
+    def push(self, version, key):
+        with self.condition:
+            if len(self.changes) >= self.size:
+                self.changes.clear()
+                self.overflow = True
+            elif not self.overflow:
+                self.changes.append((version, key))
+            self.condition.notify()
+
+# ------------------------------------------------------------------------------------------------------
+    # We wait for changes (at most timeout seconds) and take them all: (overflow, [(version, key), ...])
+    def pop(self, timeout):
+        with self.condition:
+            if not self.changes and not self.overflow:
+                self.condition.wait(timeout)
+            changes = (self.overflow, list(self.changes))
+            self.changes.clear()
+            self.overflow = False
+            return changes
+
+# ------------------------------------------------------------------------------------------------------
+
+class BoardEvents:
+# ------------------------------------------------------------------------------------------------------
+    def __init__(self, buffer_size):
+        # size of the buffer of each subscriber
+        self.buffer_size = buffer_size
+        # the subscribers connected
+        self.subscribers = set()
+        # protects the set of subscribers
+        self.lock = Lock()
+
+# ------------------------------------------------------------------------------------------------------
+    # A new subscriber, it receives the changes from now on
+    def subscribe(self):
+        subscriber = BoardSubscriber(self.buffer_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+# ------------------------------------------------------------------------------------------------------
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+# ------------------------------------------------------------------------------------------------------
+    # A change of the store is pushed to all the subscribers
+    def publish(self, version, key):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.push(version, key)
+
+# ------------------------------------------------------------------------------------------------------
+    # Number of subscribers connected
+    def count(self):
+        with self.lock:
+            return len(self.subscribers)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+#       State of a connection served by the event loop
+# ------------------------------------------------------------------------------------------------------
+class EventLoopConnection:
+    def __init__(self, address):
+        # address of the browser or vessel
+        self.address = address
+        # bytes received and not handled yet
+        self.input = ""
+        # bytes of the responses not sent yet
+        self.output = ""
+        # the connection is closed once the output is sent
+        self.close = False
+
+# ------------------------------------------------------------------------------------------------------
+    # Take the first complete request (headers and Content-Length bytes of body) out of the input
+    def next_request(self):
+        end = self.input.find("\r\n\r\n")
+        if end < 0:
+            return None
+        length = 0
+        for line in self.input[:end].split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                try:
+                    length = int(value)
+                except ValueError:
+                    length = 0
+        size = end + 4 + length
+        if len(self.input) < size:
+            return None
+        request = self.input[:size]
+        self.input = self.input[size:]
+        return request
+
+
+# ------------------------------------------------------------------------------------------------------
+#       Event loop serving engine
+# ------------------------------------------------------------------------------------------------------
+# One thread waits with select() on the listening socket and on every open connection. A request is read
+# without blocking until it is complete, handled from memory by the request handler, and its response is
+# written back without blocking, so many polling browsers and vessels cost one socket each, not one thread
+class EventLoopMixIn:
+    # bytes read from a socket at once
+    read_size = 65536
+
+# ------------------------------------------------------------------------------------------------------
+    def serve_forever(self, poll_interval=0.5):
+        # open connections: socket -> EventLoopConnection
+        self.connections = {}
+        self.listening = True
+        self.socket.setblocking(0)
+        while self.listening:
+            readers = [self.socket] + self.connections.keys()
+            writers = [sock for sock, connection in self.connections.items() if connection.output]
+            try:
+                readable, writable = select(readers, writers, [], poll_interval)[:2]
+            except select_error as e:
+                # interrupted by a signal, we wait again
+                if e.args[0] == EINTR:
+                    continue
+                raise
+            for sock in readable:
+                if sock is self.socket:
+                    self.accept_connection()
+                elif sock in self.connections:
+                    self.read_connection(sock)
+            for sock in writable:
+                if sock in self.connections:
+                    self.write_connection(sock)
+
+# ------------------------------------------------------------------------------------------------------
+    def shutdown(self):
+        self.listening = False
+
+# ------------------------------------------------------------------------------------------------------
+    def server_close(self):
+        for sock in getattr(self, "connections", {}).keys():
+            self.close_connection(sock)
+        HTTPServer.server_close(self)
+
+# ------------------------------------------------------------------------------------------------------
+    def accept_connection(self):
+        try:
+            sock, address = self.socket.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        # the responses are written in one piece, there is nothing to wait for
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[sock] = EventLoopConnection(address)
+
+# ------------------------------------------------------------------------------------------------------
+    def close_connection(self, sock):
+        del self.connections[sock]
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+# ------------------------------------------------------------------------------------------------------
+    def read_connection(self, sock):
+        connection = self.connections[sock]
+        try:
+            data = sock.recv(self.read_size)
+        except socket.error as e:
+            if e.args[0] in (EAGAIN, EWOULDBLOCK):
+                return
+            data = ""
+        # the browser or vessel closed the connection
+        if not data:
+            self.close_connection(sock)
+            return
+        connection.input += data
+        # several requests may be pipelined on the same connection
+        while not connection.close:
+            request = connection.next_request()
+            if request is None:
+                break
+            self.handle_buffered_request(connection, request)
+        self.write_connection(sock)
+
+# ------------------------------------------------------------------------------------------------------
+    def write_connection(self, sock):
+        connection = self.connections[sock]
+        if connection.output:
+            try:
+                sent = sock.send(connection.output)
+            except socket.error as e:
+                if e.args[0] in (EAGAIN, EWOULDBLOCK):
+                    return
+                self.close_connection(sock)
+                return
+            connection.output = connection.output[sent:]
+        if not connection.output and connection.close:
+            self.close_connection(sock)
+
+# ------------------------------------------------------------------------------------------------------
+    # The request handler reads the request from memory and writes its response in memory, the socket is
+    # never touched by it (setup() and finish() of the handler are not used)
+    def handle_buffered_request(self, connection, request):
+        # the handler is created without calling its __init__, which would serve the socket itself
+        handler = InstanceType(self.RequestHandlerClass)
+        handler.server = self
+        handler.request = None
+        handler.client_address = connection.address
+        handler.rfile = StringIO(request)
+        handler.wfile = StringIO()
+        handler.close_connection = 1
+        try:
+            handler.handle_one_request()
+        except Exception:
+            self.handle_error(None, connection.address)
+            handler.close_connection = 1
+        connection.output += handler.wfile.getvalue()
+        connection.close = bool(handler.close_connection)
+
 # ------------------------------------------------------------------------------------------------------
 
 
@@ -99,64 +819,124 @@ class Message:
 #       Class blackboard server
 # ------------------------------------------------------------------------------------------------------
 class BlackboardServer(HTTPServer):
+    # the responses cannot stay open (the events of the board are only polled)
+    streaming = False
+    # the requests can wait for a place in the sender queue (SENDER_QUEUE_BLOCK)
+    sender_waits = True
 # ------------------------------------------------------------------------------------------------------
     def __init__(self, server_address, handler, node_id, vessel_list):
         # We call the super init
         HTTPServer.__init__(self, server_address, handler)
-        # we create the list of values
-        self.store = []
-        # We keep a variable of the next id to insert
-        self.current_key = -1
+        # we create the list of values, ordered by unique id
+        self.store = OrderedStore()
+        # Lamport clock of the posts: the last clock value seen on this vessel
+        self.current_key = 0
+        # Version of the store, incremented by each add, modify and delete
+        self.version = 0
+        # Contents of the board rendered for a version of the store, in chunks: (version, [html, ...])
+        self.board_cache = None
+        # The pages with the board compressed for a version of the store: (encoding, head, tail) -> (version, bytes)
+        self.compressed_cache = {}
+        # Start of the server (in ms), in the ETags of the versions of the board
+        self.started = int(time() * 1000)
+        # The last changes of the store: (version, unique id), for the delta updates of the board
+        self.changes = deque(maxlen=CHANGES_KEPT)
+        # The browsers receiving the changes of the board as they happen (/board/events)
+        self.board_events = BoardEvents(EVENTS_BUFFER_SIZE)
         # our own ID (IP is 10.1.0.ID)
         self.vessel_id = vessel_id
         # The list of other vessels
         self.vessels = vessel_list
-        #list of action in a waiting list
-        self.wait_list = []
+        # The persistent connections to the other vessels
+        self.connection_pool = VesselConnectionPool(PORT_NUMBER)
+        # The workers sending the messages to the other vessels
+        self.fanout = VesselFanout(FANOUT_PARALLELISM)
+        # The batches of replication messages, sent through the fan-out
+        self.batcher = ReplicationBatcher(self.fanout, self.contact_vessel_batch, BATCH_SIZE, BATCH_WINDOW)
+        # The workers running the propagation of the requests
+        self.sender = SenderQueue(SENDER_WORKERS, SENDER_QUEUE_SIZE, SENDER_QUEUE_BLOCK and self.sender_waits)
+        # The modifies and deletes received before their post: unique id -> (arrival time, [(action, value)])
+        self.pending = {}
+        # The unique ids of the pending operations, in order of arrival (expiration)
+        self.pending_order = deque()
+        # The unique ids of the last DELETED_KEPT deleted posts, and their order of deletion
+        self.deleted = set()
+        self.deleted_order = deque()
 
 # ------------------------------------------------------------------------------------------------------
     # We add a value received to the store
     def add_value_to_store_new(self, m):
         # We add the value to the store
-        # next id
-        self.current_key = self.current_key + 1
-        idi = self.current_key
-        ip = self.vessel_id
-
         # store in the dict
         message = ''.join(m)
 
-        #uni_id: varible that stores an unique id that doesn't change during all the program
-        #this is form by two numbers: the host id of Ip address(last number) and seq.number (current_key)
-        #the first  numbers are form the seq.munber and the lat two numbers are from the IP
-        #uni_id = [ seq.number | IP ]
-        #by our choice of simplification, we assume that the maximum number of nodes are 100, which for the simulation
-        #using the mininet is perfect resonable, but if we for some way needed more node we could easly change this part
-        #of the code to be possible store more node
-        if ip < 10:
-            uni_id = int("%d0%d" %(idi, ip))
-        else:
-            uni_id = int("%d%d" %(idi, ip))
+        with mutex:
+            # next value of the Lamport clock
+            self.current_key = self.current_key + 1
+
+            #uni_id: varible that stores an unique id that doesn't change during all the program
+            #this is the pair (Lamport clock, vessel id) packed in one integer: uni_id = [ clock | vessel id ]
+            #so the posts are ordered by clock, and by vessel id for the same clock, with a native integer comparison
+            uni_id = make_unique_id(self.current_key, self.vessel_id)
 
+            newmessage = Message(uni_id, message)
 
-        newmessage = Message(uni_id, message, idi)
+            self.store.add(newmessage)
+            self.store_changed(uni_id)
 
-        self.store.append(newmessage)
+        #the unique id is sent to the other vessels
+        return uni_id
 
 
 # ------------------------------------------------------------------------------------------------------
     # We add a value received from another vessel to the store
     def add_value_to_store(self, m, unique_id):
 
-        # next id
-        self.current_key = self.current_key + 1
-
         # store in the dict
         message = ''.join(m)
-        newmessage = Message(unique_id, message, self.current_key)
 
-        self.store.append(newmessage)
+        with mutex:
+            # the Lamport clock moves past the clock of the post, our next posts come after it
+            self.current_key = max(self.current_key, unique_id >> VESSEL_ID_BITS)
+            newmessage = Message(unique_id, message)
+
+            # the post is inserted at its place on the board, and only once if we receive it twice
+            # (a post received again after its delete stays deleted)
+            if unique_id not in self.deleted and self.store.add(newmessage):
+                self.store_changed(unique_id)
+                # the modifies and deletes which arrived before the post are applied now, in their order
+                waiting = self.pending.pop(unique_id, None)
+                if waiting is not None:
+                    for action, value in waiting[1]:
+                        if action == modi_post:
+                            self.modify_value_in_store(unique_id, value)
+                        elif action == del_post:
+                            self.delete_value_in_store(unique_id)
+
+
+# ------------------------------------------------------------------------------------------------------
+    # We apply a message received from another vessel
+    def apply_replicated(self, path, action, uni_id, value):
+        if action == add_post:
+            #if the id is not occupy with other post - there isn't any conflict
+            self.add_value_to_store(value, uni_id)
+
+        elif action == modi_post:
+            # update value
+            self.modify_value_in_store(uni_id, value)
+
+        elif action == del_post:
+            # delete value
+            self.delete_value_in_store(uni_id)
 
+# ------------------------------------------------------------------------------------------------------
+    # We apply a batch of messages received from another vessel, all at once
+    def apply_replicated_batch(self, post_data):
+        messages = zip(post_data['path'], post_data['action'], post_data['key'], post_data['value'])
+        # the readers of the store (and the reconciliation) never see half of the batch
+        with mutex:
+            for path, action, uni_id, value in messages:
+                self.apply_replicated(path, action, int(uni_id), value)
 
 # ------------------------------------------------------------------------------------------------------
     # We modify a value received in the store
@@ -166,19 +946,17 @@ class BlackboardServer(HTTPServer):
 
         mes= ''.join(value)
 
-        for i in range (0, len(self.store)):
-            if self.store[i].uniqueid == uni_id:
-                self.store[i].message = mes
+        with mutex:
+            message = self.store.get(uni_id)
+            if message is not None:
+                message.message = intern(mes)
+                self.store_changed(uni_id)
                 wait_action = True
-                break
 
-        if wait_action == False:
-        #the information on vessel is not fully update - we have to wait
-        #add this action in a list
-            wait_node = Message(uni_id, mes, None)
-            wait_node.action = modi_post
-
-            self.wait_list.append(wait_node)
+            if wait_action == False:
+            #the information on vessel is not fully update - we have to wait
+            #the action waits for the post
+                self.wait_for_post(uni_id, modi_post, mes)
 
 
 
@@ -187,43 +965,289 @@ class BlackboardServer(HTTPServer):
     def delete_value_in_store(self, uni_id):
         # we delete a value in the store if it exists
         wait_action = False
-        for i in range (0, len(self.store)):
-            if self.store[i].uniqueid == uni_id:
+        with mutex:
+            if self.store.remove(uni_id) is not None:
+                self.store_changed(uni_id)
+                self.post_deleted(uni_id)
                 wait_action = True
-                self.store.pop(i)
+
+
+            if wait_action == False:
+                self.wait_for_post(uni_id, del_post, None)
+
+
+# ------------------------------------------------------------------------------------------------------
+    # We keep a modify or a delete until its post arrives (called with the mutex)
+    def wait_for_post(self, uni_id, action, value):
+        # the post was deleted already, it will not arrive again
+        if uni_id in self.deleted:
+            return
+        waiting = self.pending.get(uni_id)
+        if waiting is None:
+            arrival = time()
+            waiting = self.pending[uni_id] = (arrival, [])
+            self.pending_order.append((arrival, uni_id))
+        waiting[1].append((action, value))
+
+# ------------------------------------------------------------------------------------------------------
+    # We remember a deleted post, only the last DELETED_KEPT of them (called with the mutex)
+    def post_deleted(self, uni_id):
+        self.deleted.add(uni_id)
+        self.deleted_order.append(uni_id)
+        if len(self.deleted_order) > DELETED_KEPT:
+            self.deleted.discard(self.deleted_order.popleft())
+
+# ------------------------------------------------------------------------------------------------------
+    # We drop the operations waiting for a post for more than timeout seconds, and return their number
+    def expire_pending(self, timeout):
+        expired = 0
+        limit = time() - timeout
+        with mutex:
+            while len(self.pending_order) > 0 and self.pending_order[0][0] < limit:
+                arrival, uni_id = self.pending_order.popleft()
+                waiting = self.pending.get(uni_id)
+                # the operations may have been applied already, or be newer ones for the same post
+                if waiting is not None and waiting[0] == arrival:
+                    del self.pending[uni_id]
+                    expired += len(waiting[1])
+        return expired
+
+# ------------------------------------------------------------------------------------------------------
+    # We record a change of the store (called with the mutex)
+    def store_changed(self, uni_id):
+        self.version += 1
+        self.changes.append((self.version, uni_id))
+        self.board_events.publish(self.version, uni_id)
+
+# ------------------------------------------------------------------------------------------------------
+    # The board rendered for the current version of the store, in chunks (None if it is not rendered yet)
+    def cached_board(self):
+        chunks = None
+        with mutex:
+            if self.board_cache is not None and self.board_cache[0] == self.version:
+                chunks = self.board_cache[1]
+        return chunks
+
+# ------------------------------------------------------------------------------------------------------
+    # We render the board chunk by chunk (STREAM_CHUNK_ENTRIES entries), the mutex is only held for a chunk
+    # the chunks are kept as the cache of the board if the store did not change in the meantime
+    def render_board(self):
+        with mutex:
+            version = self.version
+            size = len(self.store)
+        chunk = boardcontents_compiled.segments[0] #the new entries go into the entries slot of the boardcontents
+        if size > BOARD_PAGE_SIZE:
+            # a large board can also be seen in pages
+            chunk += '<p class="board_pages">%s</p>' % self.page_link("Pages of %d entries" % BOARD_PAGE_SIZE, 0, BOARD_PAGE_SIZE)
+        chunks = [chunk]
+        yield chunk
+        last = None
+        while True:
+            with mutex:
+                # the chunk starts after the last post sent, even if the store changed
+                keys = self.store.keys
+                start = 0 if last is None else bisect_right(keys, last)
+                ids = keys[start:start + STREAM_CHUNK_ENTRIES]
+                #for every item in the chunk, in the order of the board (i is the position on the board)
+                chunk = ''.join([entry_compiled.render("entries/" + str(uni_id), start + j, self.store.get(uni_id).message)
+                                 for j, uni_id in enumerate(ids)]) #create entries
+            if not ids:
                 break
+            last = ids[-1]
+            chunks.append(chunk)
+            yield chunk
+        chunk = boardcontents_compiled.segments[1]
+        chunks.append(chunk)
+        yield chunk
+        with mutex:
+            if self.version == version:
+                self.board_cache = (version, chunks)
+
+# ------------------------------------------------------------------------------------------------------
+    # The contents of the board, rendered once for each version of the store
+    def board_contents(self):
+        chunks = self.cached_board()
+        if chunks is None:
+            chunks = list(self.render_board())
+        return ''.join(chunks)
+
+# ------------------------------------------------------------------------------------------------------
+    # The board between head and tail compressed with gzip or deflate, once for each version of the store
+    def compressed_board(self, head, tail, encoding):
+        with mutex:
+            version = self.version
+            cached = self.compressed_cache.get((encoding, head, tail))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        chunks = self.cached_board()
+        if chunks is None:
+            chunks = list(self.render_board())
+        # gzip has a header and a trailer around the deflate (zlib) stream
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        data = ''.join([compressor.compress(chunk) for chunk in chain([head], chunks, [tail])]) + compressor.flush()
+        with mutex:
+            # kept only if the board compressed is the one of this version
+            if self.version == version:
+                self.compressed_cache[(encoding, head, tail)] = (version, data)
+        return data
+
+# ------------------------------------------------------------------------------------------------------
+    # A link to a page of the board: by position (offset) or by key (from, to)
+    def page_link(self, text, offset, limit, first=None, last=None):
+        if first is None:
+            query = "offset=%d&amp;limit=%d" % (offset, limit)
+        else:
+            query = "from=%d&amp;limit=%d" % (first, limit)
+            if last is not None:
+                query += "&amp;to=%d" % last
+        return '<a href="/?%s">%s</a>' % (query, text)
 
+# ------------------------------------------------------------------------------------------------------
+    # The contents of the board for a page: limit entries from the position offset, or from the unique id first
+    # (with the unique ids up to last), with the links to the previous and the next pages
+    def board_page(self, offset, limit, first=None, last=None):
+        with mutex:
+            keys = self.store.keys
+            start = offset if first is None else bisect_left(keys, first)
+            end = len(keys) if last is None else bisect_right(keys, last)
+            page = keys[start:min(start + limit, end)]
+            #for every item of the page, i is the position on the board
+            new_entry = [entry_compiled.render("entries/" + str(uni_id), start + j, self.store.get(uni_id).message)
+                         for j, uni_id in enumerate(page)] #create entries
+            size = len(keys)
+            previous_key = keys[max(0, start - limit)] if 0 < start <= size else None
+        links = []
+        if start > 0:
+            if first is None:
+                links.append(self.page_link("Previous", max(0, start - limit), limit))
+            elif previous_key is not None:
+                links.append(self.page_link("Previous", 0, limit, previous_key, last))
+        if start + len(page) < end:
+            if first is None:
+                links.append(self.page_link("Next", start + len(page), limit))
+            else:
+                links.append(self.page_link("Next", 0, limit, page[-1] + 1, last))
+        if page:
+            status = "Entries %d to %d of %d" % (start, start + len(page) - 1, size)
+        else:
+            status = "No entries in this page (%d on the board)" % size
+        links.append('<a href="/">Whole board</a>')
+        nav = '<p class="board_pages">%s %s</p>' % (status, ' '.join(links))
+        #put the entries of the page into the boardcontents
+        return boardcontents_compiled.fill(entries=nav + ''.join(new_entry))
+
+# ------------------------------------------------------------------------------------------------------
+    # The entry of the board for a unique id (None if the post is not on the board)
+    def board_entry(self, uni_id):
+        entry = None
+        with mutex:
+            message = self.store.get(uni_id)
+            if message is not None:
+                #the position of the post on the board
+                i = bisect_left(self.store.keys, uni_id)
+                entry = entry_compiled.render("entries/" + str(uni_id), i, message.message)
+        return entry
+
+# ------------------------------------------------------------------------------------------------------
+    # The changes of the board after a version: (version, None, [(unique id, entry or None if deleted)]),
+    # or the whole board (version, contents of the board, None) if these changes are not kept anymore
+    def board_changes(self, since):
+        with mutex:
+            if since == self.version:
+                changes = (self.version, None, [])
+            elif since < 0 or since > self.version or len(self.changes) == 0 or self.changes[0][0] > since + 1:
+                changes = (self.version, self.board_contents(), None)
+            else:
+                ids = set()
+                for version, uni_id in reversed(self.changes):
+                    if version <= since:
+                        break
+                    ids.add(uni_id)
+                changes = (self.version, None, [(uni_id, self.board_entry(uni_id)) for uni_id in sorted(ids)])
+        return changes
+
+# ------------------------------------------------------------------------------------------------------
+    # The entries of a page of the board for the machine API (JSON): limit entries from the position offset,
+    # or from the unique id first (with the unique ids up to last), straight from the store, without the HTML
+    def api_entries(self, offset, limit, first=None, last=None):
+        with mutex:
+            keys = self.store.keys
+            start = offset if first is None else bisect_left(keys, first)
+            end = len(keys) if last is None else bisect_right(keys, last)
+            page = keys[start:min(start + limit, end)]
+            #for every item of the page, the position is its place on the board
+            entries = [{'id': uni_id, 'position': start + j, 'entry': json_text(self.store.get(uni_id).message)}
+                       for j, uni_id in enumerate(page)]
+            version = self.version
+            size = len(keys)
+        return self.api_page(version, size, start, end, limit, first, last, page, entries)
+
+# ------------------------------------------------------------------------------------------------------
+    # We serialize the whole board for the export, one JSON line for each entry (NDJSON), in chunks of
+    # STREAM_CHUNK_ENTRIES entries, the mutex is only held for a chunk (as when the board is rendered)
+    def export_entries(self):
+        last = None
+        while True:
+            with mutex:
+                # the chunk starts after the last post sent, even if the store changed
+                keys = self.store.keys
+                start = 0 if last is None else bisect_right(keys, last)
+                ids = keys[start:start + STREAM_CHUNK_ENTRIES]
+                chunk = ''.join([json.dumps({'id': uni_id, 'position': start + j,
+                                             'entry': json_text(self.store.get(uni_id).message)}) + '\n'
+                                 for j, uni_id in enumerate(ids)])
+            if not ids:
+                break
+            last = ids[-1]
+            yield chunk
+
+# ------------------------------------------------------------------------------------------------------
+    # A page of the machine API, with the query of the next page (None after the last page)
+    def api_page(self, version, size, start, end, limit, first, last, page, entries):
+        next_page = None
+        if start + len(page) < end:
+            if first is None:
+                next_page = "/api/entries?offset=%d&limit=%d" % (start + len(page), limit)
+            else:
+                next_page = "/api/entries?from=%d&limit=%d" % (page[-1] + 1, limit)
+                if last is not None:
+                    next_page += "&to=%d" % last
+        return {'version': version, 'total': size, 'offset': start, 'limit': limit,
+                'entries': entries, 'next': next_page}
 
-        if wait_action == False:
-            wait_node = Message(uni_id, None, None)
-            wait_node.action = del_post
+# ------------------------------------------------------------------------------------------------------
+    # The state of the outbound queues for the monitoring (/api/status): the works waiting in the sender queue
+    # and the messages waiting in the fan-out for each vessel
+    def queue_status(self):
+        return {'sender_queue': self.sender.depth(), 'fanout': self.fanout.pending()}
 
-            self.wait_list.append(wait_node)
+# ------------------------------------------------------------------------------------------------------
+    # Number of operations waiting for their post
+    def pending_size(self):
+        with mutex:
+            size = sum(len(waiting[1]) for waiting in self.pending.values())
+        return size
 
 
 # ------------------------------------------------------------------------------------------------------
     # Contact a specific vessel with a set of variables to transmit to it
 
     def contact_vessel(self, vessel_ip, path, action, key, value, time1):
-        # the Boolean variable we will return
-        success = False
         # The variables must be encoded in the URL format, through urllib.urlencode
         post_content = urlencode({'action': action, 'key': key, 'value': value, 'time': time1})
-        # the HTTP header must contain the type of data we are transmitting, here URL encoded
-        headers = {"Content-type": "application/x-www-form-urlencoded"}
+        return self.post_to_vessel(vessel_ip, path, post_content)
+
+# ------------------------------------------------------------------------------------------------------
+    # Send an encoded content to a specific vessel
+    def post_to_vessel(self, vessel_ip, path, post_content, content_type="application/x-www-form-urlencoded"):
+        # the Boolean variable we will return
+        success = False
+        # the HTTP header must contain the type of data we are transmitting, URL encoded or binary
+        headers = {"Content-type": content_type}
         # We should try to catch errors when contacting the vessel
         try:
-            # We contact vessel:PORT_NUMBER since we all use the same port
-            # We can set a timeout, after which the connection fails if nothing happened
-            connection = HTTPConnection("%s:%d" % (vessel_ip, PORT_NUMBER), timeout=30)
-            # We only use POST to send data (PUT and DELETE not supported)
-            action_type = "POST"
-            # We send the HTTP request
-            connection.request(action_type, path, post_content, headers)
-            # We retrieve the response
-            response = connection.getresponse()
-            # We want to check the status, the body should be empty
-            status = response.status
+            # We reuse a kept-alive connection of the pool when possible (PUT and DELETE not supported)
+            status = self.connection_pool.post(vessel_ip, path, post_content, headers)
             # If we receive a HTTP 200 - OK
             if status == 200:
                 success = True
@@ -236,6 +1260,13 @@ class BlackboardServer(HTTPServer):
         # we return if we succeeded or not
         return success
 
+# ------------------------------------------------------------------------------------------------------
+    # Contact a specific vessel with a batch of messages [(path, action, key, value, time1), ...]
+    def contact_vessel_batch(self, vessel_ip, messages):
+        # one row per message, the names of the fields are sent only once
+        post_content = encode_messages(['path', 'action', 'key', 'value', 'time'], messages)
+        return self.post_to_vessel(vessel_ip, "/replication", post_content, BINARY_CONTENT_TYPE)
+
 # ------------------------------------------------------------------------------------------------------
     # We send a received value to all the other vessels of the system
     def propagate_value_to_vessels(self, path, action, key, value, time1):
@@ -245,9 +1276,31 @@ class BlackboardServer(HTTPServer):
             if vessel != ("10.1.0.%s" % self.vessel_id):
                 # A good practice would be to try again if the request failed
                 # Here, we do it only once
-                self.contact_vessel(vessel, path, action, key, value, time1)
+                # The message waits in the batch of the vessel, the vessels are contacted in parallel
+                self.batcher.add(vessel, (path, action, key, value, time1))
+
+
+# ------------------------------------------------------------------------------------------------------
 
 
+
+# ------------------------------------------------------------------------------------------------------
+#       Serving engines
+# ------------------------------------------------------------------------------------------------------
+# threads: every connection is handled by its own thread
+class ThreadedBlackboardServer(ThreadingMixIn, BlackboardServer):
+    # the persistent connections of the other vessels must not block each other
+    daemon_threads = True
+    # a thread can stay on a response and stream it (/board/events)
+    streaming = True
+
+# select: every connection is handled by a single event loop
+class EventLoopBlackboardServer(EventLoopMixIn, BlackboardServer):
+    # a request waiting for a place in the sender queue would stop the loop: its propagation is rejected,
+    # and the writes of our own are refused (503) while the queue is full
+    sender_waits = False
+
+SERVING_ENGINES = {"threads": ThreadedBlackboardServer, "select": EventLoopBlackboardServer}
 # ------------------------------------------------------------------------------------------------------
 
 
@@ -260,27 +1313,102 @@ class BlackboardServer(HTTPServer):
 # i.e. the store is accessible through self.server.store
 # Attributes of the server are SHARED accross all request hqndling/ threads!
 class BlackboardRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 lets the other vessels (and the browsers) reuse their connection for the next request
+    protocol_version = "HTTP/1.1"
+    # the headers are written one by one, without Nagle they are not delayed on a kept-alive socket
+    disable_nagle_algorithm = True
 # ------------------------------------------------------------------------------------------------------
     # We fill the HTTP headers
-    def set_HTTP_headers(self, status_code=200):
+    def set_HTTP_headers(self, status_code=200, length=0, content_type="text/html", etag=None, encoding=None):
         # We set the response status code (200 if OK, something else otherwise)
         self.send_response(status_code)
-        # We set the content type to HTML
-        self.send_header("Content-type", "text/html")
+        # We set the content type (HTML, except for the delta updates of the board)
+        self.send_header("Content-type", content_type)
+        # The length of the body is needed to keep the connection open after the response
+        # (no length: the body is sent in chunks, each with its length)
+        if length is None:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(length))
+        # The board is sent compressed (gzip, deflate) or not (identity), depending on the browser
+        if encoding is not None:
+            if encoding != 'identity':
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+        # The version of the page, the browser must ask with it (If-None-Match) before using its copy
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
         # No more important headers, we can close them
         self.end_headers()
 
+# ------------------------------------------------------------------------------------------------------
+    # The strong ETag of a version of the page (the versions restart with the server, not the ETags)
+    # (and of its encoding, a compressed page is not the same bytes)
+    def version_etag(self, version, encoding='identity'):
+        if encoding != 'identity':
+            return '"%d-%d-%s"' % (self.server.started, version, encoding)
+        return '"%d-%d"' % (self.server.started, version)
+
+# ------------------------------------------------------------------------------------------------------
+    # The compression of the board accepted by the browser (Accept-Encoding): gzip, deflate or identity
+    def accepted_encoding(self):
+        accept_encoding = self.headers.getheader('Accept-Encoding')
+        if accept_encoding is None:
+            return 'identity'
+        accepted = {}
+        for item in accept_encoding.split(','):
+            name, _, parameters = item.partition(';')
+            quality = 1.0
+            parameters = parameters.strip()
+            if parameters.startswith('q='):
+                try:
+                    quality = float(parameters[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[name.strip().lower()] = quality
+        for encoding in ('gzip', 'deflate'):
+            if accepted.get(encoding, 0.0) > 0.0:
+                return encoding
+        return 'identity'
+
+# ------------------------------------------------------------------------------------------------------
+    # We answer 304 (Not Modified), without body, if the browser already has this version of the page
+    def not_modified(self, etag):
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if etag not in tags and 'W/' + etag not in tags and '*' not in tags:
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return True
+
 # ------------------------------------------------------------------------------------------------------
     # a POST request must be parsed through urlparse.parse_QS, since the content is URL encoded
     def parse_POST_request(self):
         post_data = ""
         # We need to parse the response, so we must know the length of the content
         length = int(self.headers['Content-Length'])
-        # we can now parse the content using parse_qs
-        post_data = parse_qs(self.rfile.read(length), keep_blank_values=1)
+        post_content = self.rfile.read(length)
+        # the other vessels send binary messages, the browsers send URL encoded forms
+        if self.headers.getheader('Content-type') == BINARY_CONTENT_TYPE:
+            post_data = decode_messages(post_content)
+        else:
+            # we can now parse the content using parse_qs
+            post_data = parse_qs(post_content, keep_blank_values=1)
         # we return the data
         return post_data
 # ------------------------------------------------------------------------------------------------------
+    # The sender queue is full and the requests cannot wait for a place in it: we answer 503 and return True
+    def sender_refuses(self):
+        if self.server.sender.block or not self.server.sender.full():
+            return False
+        self.send_error(503, "Sender queue full, try again later")
+        return True
+# ------------------------------------------------------------------------------------------------------
 
 # ------------------------------------------------------------------------------------------------------
 # Request handling - GET
@@ -290,10 +1418,48 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         print("Receiving a GET on path %s" % self.path)
         # if path is /board, only the boardcontents template should be updated, else the whole page
-        if self.path == '/board':
-            self.update_board()
+        # (/board?since=N: only the changes of the board after the version N)
+        # (?offset=O&limit=N or ?from=K&to=K&limit=N: only a page of the board)
+        # /api/entries (a page of the entries in JSON) and /api/export (all of them, NDJSON) are for the tools
+        # /api/status (the depth of the outbound queues) is for the monitoring
+        path, _, query = self.path.partition('?')
+        arguments = parse_qs(query)
+        try:
+            since = int(arguments['since'][0]) if 'since' in arguments else None
+            page = self.page_arguments(arguments)
+        except ValueError:
+            self.send_error(400, "since, offset, limit, from and to must be numbers")
+            return
+        if path == '/board/events':
+            self.stream_board_events()
+        elif path == '/api/entries':
+            self.send_api_entries(page)
+        elif path == '/api/export':
+            self.send_api_export()
+        elif path == '/api/status':
+            self.send_api_status()
+        elif path == '/board':
+            if since is not None:
+                self.update_board_since(since)
+            elif page is not None:
+                self.update_board_page(page)
+            else:
+                self.update_board()
         else:
-            self.do_GET_Index()
+            self.do_GET_Index(page)
+
+# ------------------------------------------------------------------------------------------------------
+    # The page of the board asked: (offset, limit, from, to), None for the whole board
+    def page_arguments(self, arguments):
+        if not [name for name in ('offset', 'limit', 'from', 'to') if name in arguments]:
+            return None
+        offset = int(arguments['offset'][0]) if 'offset' in arguments else 0
+        limit = int(arguments['limit'][0]) if 'limit' in arguments else BOARD_PAGE_SIZE
+        first = int(arguments['from'][0]) if 'from' in arguments else None
+        last = int(arguments['to'][0]) if 'to' in arguments else None
+        if offset < 0 or limit <= 0:
+            raise ValueError("offset and limit out of range")
+        return (offset, limit, first, last)
 
 
 # ------------------------------------------------------------------------------------------------------
@@ -301,41 +1467,166 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 # ------------------------------------------------------------------------------------------------------
 
     def update_board(self):
-        self.set_HTTP_headers(200)
-        new_entry = ""
-
-        for i in range (0, len(self.server.store) ):
-        #for every item in store
-            idi = self.server.store[i].uniqueid
-            entry = entry_template % ("entries/" + str(idi), i, (self.server.store[i].message)) #create entries
-            new_entry += entry
-        newboard = boardcontents_template #put the new entries into the boardcontents
-        newboard = newboard[:-5]
-        newboard += '<p>'
-        newboard += new_entry
-        newboard += '</div>'
+        # the version is read before the board, the board sent is never older than its ETag
+        encoding = self.accepted_encoding()
+        etag = self.version_etag(self.server.version, encoding)
+        if self.not_modified(etag):
+            return
+        # the board is rendered (and compressed) again only if the store changed since the last request
+        self.send_board('', '', etag, encoding)
+
+# ------------------------------------------------------------------------------------------------------
+    # We send the board between head and tail: from the cache when it is current, with its length,
+    # else while it is rendered, in chunks (chunked transfer encoding), without waiting for the whole board
+    # compressed, it is sent from the cache of the compressed board, with its length
+    def send_board(self, head, tail, etag=None, encoding='identity'):
+        if encoding != 'identity':
+            body = self.server.compressed_board(head, tail, encoding)
+            self.set_HTTP_headers(200, len(body), etag=etag, encoding=encoding)
+            self.wfile.write(body)
+            return
+        chunks = self.server.cached_board()
+        if chunks is None and self.request_version != 'HTTP/1.1':
+            # there is no chunked transfer encoding before HTTP/1.1
+            chunks = list(self.server.render_board())
+        if chunks is not None:
+            # We set the response status code to 200 (OK) and the length of the page
+            self.set_HTTP_headers(200, len(head) + sum(len(chunk) for chunk in chunks) + len(tail), etag=etag, encoding=encoding)
+            self.wfile.write(head)
+            for chunk in chunks:
+                self.wfile.write(chunk)
+            self.wfile.write(tail)
+        else:
+            self.set_HTTP_headers(200, None, etag=etag, encoding=encoding)
+            self.write_chunked(chain([head], self.server.render_board(), [tail]))
+
+# ------------------------------------------------------------------------------------------------------
+    # We write the body in chunks as they come (chunked transfer encoding), each with its length
+    def write_chunked(self, chunks):
+        for chunk in chunks:
+            if chunk:
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        # the last chunk is empty
+        self.wfile.write("0\r\n\r\n")
+
+# ------------------------------------------------------------------------------------------------------
+    # Only a page of the board
+    def update_board_page(self, page):
+        # the version is read before the page, the page sent is never older than its ETag
+        etag = self.version_etag(self.server.version)
+        if self.not_modified(etag):
+            return
+        newboard = self.server.board_page(*page)
+        # We set the response status code to 200 (OK) and the length of the page
+        self.set_HTTP_headers(200, len(newboard), etag=etag)
         self.wfile.write(newboard)
+
 # ------------------------------------------------------------------------------------------------------
+    # Only the entries added, modified or deleted after a version of the board, in JSON
+    # (the positions of the other posts change with an add or a delete, the page renumbers them)
+    def update_board_since(self, since):
+        # the changes after a version are the same as long as the store does not change
+        etag = self.version_etag(self.server.version)
+        if self.not_modified(etag):
+            return
+        version, contents, entries = self.server.board_changes(since)
+        delta = self.board_delta(version, contents, entries)
+        self.set_HTTP_headers(200, len(delta), "application/json", etag)
+        self.wfile.write(delta)
 
-    def do_GET_Index(self):
-        # We set the response status code to 200 (OK)
-        self.set_HTTP_headers(200)
-        # We should do some real HTML here
+# ------------------------------------------------------------------------------------------------------
+    # A delta update of the board in JSON, the contents and the entries are sent as text
+    def board_delta(self, version, contents, entries):
+        if entries is not None:
+            entries = [(key, json_text(entry)) for key, entry in entries]
+        return json.dumps({'version': version, 'full': json_text(contents), 'entries': entries, 'renumber': True})
 
-        html_reponse = board_frontpage_header_template + boardcontents_template + board_frontpage_footer_template
-        new_entry = ""
+# ------------------------------------------------------------------------------------------------------
+    # The machine API: a page of the entries in JSON (the first BOARD_PAGE_SIZE entries without page arguments)
+    def send_api_entries(self, page):
+        # the version is read before the page, the page sent is never older than its ETag
+        etag = self.version_etag(self.server.version)
+        if self.not_modified(etag):
+            return
+        if page is None:
+            page = (0, BOARD_PAGE_SIZE, None, None)
+        body = json.dumps(self.server.api_entries(*page))
+        self.set_HTTP_headers(200, len(body), "application/json", etag)
+        self.wfile.write(body)
 
-        for i in range (0, len(self.server.store) ):#for each item in store, create entries
-            idi = self.server.store[i].uniqueid
-            entry = entry_template % ("entries/" + str(idi), i, self.server.store[i].message)
-            new_entry += entry
-        boardcontents_template2 = boardcontents_template[:-5] #put the new entries into the boardcontents
-        boardcontents_template2 += '<p>'
-        boardcontents_template2 += new_entry
-        boardcontents_template2 += '</div>'
-        html_reponse = board_frontpage_header_template + boardcontents_template2 + board_frontpage_footer_template
+# ------------------------------------------------------------------------------------------------------
+    # The machine API: all the entries, one JSON line each (NDJSON), sent in chunks while they are serialized
+    def send_api_export(self):
+        chunks = self.server.export_entries()
+        if self.request_version != 'HTTP/1.1':
+            # there is no chunked transfer encoding before HTTP/1.1
+            chunks = list(chunks)
+            self.set_HTTP_headers(200, sum(len(chunk) for chunk in chunks), "application/x-ndjson")
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        else:
+            self.set_HTTP_headers(200, None, "application/x-ndjson")
+            self.write_chunked(chunks)
 
-        self.wfile.write(html_reponse)
+# ------------------------------------------------------------------------------------------------------
+    # The machine API: the depth of the outbound queues, read at each request (never cached)
+    def send_api_status(self):
+        body = json.dumps(self.server.queue_status())
+        self.set_HTTP_headers(200, len(body), "application/json")
+        self.wfile.write(body)
+
+# ------------------------------------------------------------------------------------------------------
+    # The changes of the board pushed as they happen (server-sent events), each event is a delta update
+    # the response stays open until the browser leaves, so only with the threads serving engine
+    def stream_board_events(self):
+        if not self.server.streaming:
+            self.send_error(501, "Board events need the threads serving engine")
+            return
+        # the subscriber receives the changes from now on, the first event is the whole board
+        subscriber = self.server.board_events.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            # the end of the events is the end of the connection
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = 1
+            overflow, changes = True, []
+            while True:
+                if overflow:
+                    version, contents, entries = self.server.board_changes(-1)
+                elif changes:
+                    version = changes[-1][0]
+                    contents = None
+                    entries = [(key, self.server.board_entry(key)) for key in sorted(set(key for v, key in changes))]
+                else:
+                    # nothing changed, we check that the browser is still there
+                    self.wfile.write(": keep-alive\n\n")
+                    overflow, changes = subscriber.pop(EVENTS_KEEPALIVE)
+                    continue
+                delta = self.board_delta(version, contents, entries)
+                self.wfile.write("data: %s\n\n" % delta)
+                overflow, changes = subscriber.pop(EVENTS_KEEPALIVE)
+        except socket.error:
+            # the browser left, what could not be sent is dropped (not sent again when the handler ends)
+            self.wfile = StringIO()
+        finally:
+            self.server.board_events.unsubscribe(subscriber)
+# ------------------------------------------------------------------------------------------------------
+
+    def do_GET_Index(self, page=None):
+        # We should do some real HTML here
+
+        if page is None:
+            # the entries in the boardcontents, the page is never copied whole
+            self.send_board(board_frontpage_header_template, board_frontpage_footer_template, encoding=self.accepted_encoding())
+        else:
+            # only the entries of a page of the board
+            html_reponse = board_frontpage_header_template + self.server.board_page(*page) + board_frontpage_footer_template
+            # We set the response status code to 200 (OK) and the length of the page
+            self.set_HTTP_headers(200, len(html_reponse))
+            self.wfile.write(html_reponse)
 
 # ------------------------------------------------------------------------------------------------------
 
@@ -352,13 +1643,33 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 
         id_mod_del = -1
         post_data = self.parse_POST_request()
+        # a write of our own is refused while its propagation cannot be queued (it would never reach the
+        # other vessels), if the requests do not wait for a place in the sender queue
+        if self.path != "/replication" and 'action' not in post_data and self.sender_refuses():
+            return
         self.set_HTTP_headers(200)
         retransmit = False
         start = None
         list_time = []
+        global counter
+
+
+        if self.path == "/replication":
+            # batch of updates from another vessel
+            self.server.apply_replicated_batch(post_data)
+            end = time()
+
+            for action, start_time in zip(post_data['action'], post_data['time']):
+                if action == add_post:
+                    t_reach_cons = end - float(start_time)
+                    list_time.append(t_reach_cons)
+                    with mutex:
+                        counter+=1
 
+                    if counter == num_messages:
+                        print"Time to reach consistency: %f" %(max(list_time))
 
-        if self.path == "/board":
+        elif self.path == "/board":
             # submit - add_post
             if 'action' in post_data:
                 # receive a new post from other vessels
@@ -373,19 +1684,15 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 
                     t_reach_cons = end - start_time
                     list_time.append(t_reach_cons)
-                    global counter
-                    counter+=1
+                    with mutex:
+                        counter+=1
 
                     if counter == num_messages:
                         print"Time to reach consistency: %f" %(max(list_time))
 
             else:
                 # new post - submit information write by the own vessel
-                mutex_list.acquire()
-                self.server.add_value_to_store_new(post_data['entry'])
-                size = len(self.server.store) - 1
-                key = self.server.store[size].uniqueid
-                mutex_list.release()
+                key = self.server.add_value_to_store_new(post_data['entry'])
 
                 action = add_post
                 retransmit = True
@@ -430,14 +1737,8 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
         if retransmit:
             retransmit = False
             # do_POST send the message only when the function finishes
-            # We must then create threads if we want to do some heavy computation
-            #
-            # Random content
-            thread = Thread(target=self.server.propagate_value_to_vessels, args=(self.path, action, key, ''.join(post_data['entry']), start ))
-            # We kill the process if we kill the server
-            thread.daemon = True
-            # We start the thread
-            thread.start()
+            # The propagation is queued for the workers of the sender
+            self.server.sender.submit(self.server.propagate_value_to_vessels, self.path, action, key, ''.join(post_data['entry']), start)
 
 # ------------------------------------------------------------------------------------------------------
 
@@ -447,33 +1748,21 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 #that all the vessels have the same infomation
 # ------------------------------------------------------------------------------------------------------
 
-def reconciliation(lista, wait_list):
+def reconciliation(server):
 
+    #size of the buffer at the last report
+    reported = 0
     while 1:
         sleep(1)
 
-        # lock (mutex) - only this thread has access to the critical region (self.server.store)
-        mutex.acquire()
-
-        if len(wait_list) > 0:
-        #there are some action waiting to be realize
-            for  i in range (0, len(lista) ):
-                if wait_list[i].action == modi_post:
-                #modify
-                    self.server.modify_value_in_store(wait_list[i].uniqueid, wait_list[i].message)
-
-                elif wait_list[i].action == del_post:
-                #delete
-                    self.server.delete_value_in_store(wait_list[i].uniqueid)
-
-        #order the list by the unique id
-        lista.sort( key=attrgetter('uniqueid'))
-
-        for idi in range (0, len(lista) ):
-            lista[idi].id = idi
-
-        #unlock the mutex
-        mutex.release()
+        #the store is always ordered by unique id (OrderedStore), nothing to sort nor to renumber
+        #the modifies and deletes waiting for their post are applied when it arrives (add_value_to_store)
+        #here we only drop the ones whose post never came, and report the size of the buffer when it changes
+        expired = server.expire_pending(PENDING_TIMEOUT)
+        size = server.pending_size()
+        if expired > 0 or size != reported:
+            print("Pending operations: %d waiting, %d expired" % (size, expired))
+            reported = size
 
 # ------------------------------------------------------------------------------------------------------
 
@@ -489,15 +1778,20 @@ if __name__ == '__main__':
     # .....
     vessel_list = []
     vessel_id = 0
+    serving_engine = SERVING_ENGINE
     # Checking the arguments
-    if len(sys.argv) != 3:  # 2 args, the script and the vessel name
-        print("Arguments: vessel_ID number_of_vessels")
+    # 2 args, the script and the vessel name, and optionally the serving engine
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] not in SERVING_ENGINES):
+        print("Arguments: vessel_ID number_of_vessels [threads|select]")
     else:
         # We need to know the vessel IP
         vessel_id = int(sys.argv[1])
         # We need to write the other vessels IP, based on the knowledge of their number
         for i in range(1, int(sys.argv[2]) + 1):
             vessel_list.append("10.1.0.%d" % i)  # We can add ourselves, we have a test in the propagation
+        # The serving engine can be chosen as third argument
+        if len(sys.argv) == 4:
+            serving_engine = sys.argv[3]
 
     global num_messages
     num_messages = 40 * (int(sys.argv[2]) - 1)
@@ -506,11 +1800,11 @@ if __name__ == '__main__':
     counter = 0
 
     # We launch a server
-    server = BlackboardServer(('', PORT_NUMBER), BlackboardRequestHandler, vessel_id, vessel_list)
-    print("Starting the server on port %d" % PORT_NUMBER)
+    server = SERVING_ENGINES[serving_engine](('', PORT_NUMBER), BlackboardRequestHandler, vessel_id, vessel_list)
+    print("Starting the server on port %d (%s engine)" % (PORT_NUMBER, serving_engine))
 
 
-    t = Thread(target=reconciliation, args=(server.store, server.wait_list) )
+    t = Thread(target=reconciliation, args=(server,) )
     t.daemon = True
     t.start()
 
@@ -8,12 +8,22 @@
 # ------------------------------------------------------------------------------------------------------
 # We import various libraries
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # Socket specifically designed to handle HTTP requests
+from SocketServer import ThreadingMixIn  # Handle each connection in its own thread
 import sys  # Retrieve arguments
 from urlparse import parse_qs  # Parse POST data
 from httplib import HTTPConnection  # Create a HTTP connection, as a client (for POST requests to the other vessels)
-from urllib import urlencode  # Encode POST content into the HTTP header
 from codecs import open  # Open a file
-from threading import Thread  # Thread Management
+import json  # Status of the outbound queues
+from struct import pack, unpack_from, calcsize  # Binary messages between vessels
+from Queue import Queue, Full  # Thread-safe queue
+from collections import deque  # FIFO of messages
+from select import select, error as select_error  # Wait for the sockets (event loop, idle connections)
+from errno import EINTR, EAGAIN, EWOULDBLOCK  # Errors of non-blocking sockets
+from cStringIO import StringIO  # Requests and responses in memory (event loop)
+from types import InstanceType  # Request handler of the event loop
+import socket  # Socket errors
+from threading import Thread, Lock, Condition  # Thread Management
+from time import time  # Age of the idle connections
 
 
 # ------------------------------------------------------------------------------------------------------
@@ -28,14 +38,449 @@ except Exception as e:
 # ------------------------------------------------------------------------------------------------------
 # Static variables definitions
 PORT_NUMBER = 8080
+# Serving engine used when none is given on the command line: threads or select
+SERVING_ENGINE = "threads"
+# Number of vessels contacted in parallel when a message is propagated
+FANOUT_PARALLELISM = 8
+# Content type of the binary messages between vessels
+BINARY_CONTENT_TYPE = "application/x-vessel-messages"
+# Workers of the sender queue (propagating only queues the messages in the fan-out,
+# so one worker is enough and keeps them in the order of the requests)
+SENDER_WORKERS = 1
+# Maximum number of works waiting in the sender queue
+SENDER_QUEUE_SIZE = 1000
+# When the sender queue is full, the request waits (True) or its propagation is rejected (False)
+SENDER_QUEUE_BLOCK = True
 
 
+# ------------------------------------------------------------------------------------------------------
+# Locks
+# The votes and vectors are shared by all the request handling threads
+mutex = Lock()
+
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+# Binary format of the messages between vessels (POST on /replication)
+# header:  number of fields (unsigned short), number of messages (unsigned int)
+#          then the name of every field: length (unsigned char) + bytes
+# message: the length of every field (unsigned int each, one struct), then the raw bytes of the fields
+# Decoding gives the same {field: [value of message 1, value of message 2, ...]} as parse_qs
+def encode_messages(fields, messages):
+    parts = [pack("!HI", len(fields), len(messages))]
+    for field in fields:
+        parts.append(pack("!B", len(field)))
+        parts.append(field)
+    lengths_format = "!%dI" % len(fields)
+    for message in messages:
+        # the values are sent as strings, like urlencode does
+        values = [str(value) for value in message]
+        parts.append(pack(lengths_format, *[len(value) for value in values]))
+        parts.extend(values)
+    return "".join(parts)
+
+
+def decode_messages(data):
+    number_fields, number_messages = unpack_from("!HI", data, 0)
+    offset = calcsize("!HI")
+    fields = []
+    for i in range(0, number_fields):
+        length = ord(data[offset])
+        fields.append(data[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    lengths_format = "!%dI" % number_fields
+    lengths_size = calcsize(lengths_format)
+    decoded = dict((field, []) for field in fields)
+    for i in range(0, number_messages):
+        lengths = unpack_from(lengths_format, data, offset)
+        offset += lengths_size
+        for field, length in zip(fields, lengths):
+            decoded[field].append(data[offset:offset + length])
+            offset += length
+    # a truncated content would give cut values
+    if offset != len(data):
+        raise ValueError("Malformed messages: %d bytes expected, %d received" % (offset, len(data)))
+    return decoded
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Pool of persistent (keep-alive) connections to the other vessels
+# Each vessel IP has at most max_per_vessel sockets open, an idle socket is reused by the next message
+# instead of paying a new TCP handshake, and a socket that looks closed or broken is replaced by a new one
+class VesselConnectionPool:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, port, max_per_vessel=4, timeout=30, max_idle=30):
+        # port used by every vessel
+        self.port = port
+        # maximum number of sockets (idle and busy) towards one vessel
+        self.max_per_vessel = max_per_vessel
+        # timeout of a request, after which the connection fails if nothing happened
+        self.timeout = timeout
+        # an idle socket older than this (in seconds) is closed instead of reused
+        self.max_idle = max_idle
+        # idle connections of each vessel: vessel_ip -> [(connection, last time used), ...]
+        self.idle = {}
+        # number of sockets currently opened towards each vessel: vessel_ip -> int
+        self.opened = {}
+        # protects idle and opened, and wakes up the threads waiting for a free socket
+        self.condition = Condition(Lock())
+
+    # ------------------------------------------------------------------------------------------------------
+    # An idle connection is healthy if it is not too old and the vessel did not close it meanwhile
+    def is_healthy(self, connection, last_used):
+        if time() - last_used > self.max_idle:
+            return False
+        # not connected yet, it will connect on the next request
+        if connection.sock is None:
+            return True
+        try:
+            readable = select([connection.sock], [], [], 0)[0]
+        except Exception:
+            return False
+        # nothing should be readable on an idle keep-alive socket, otherwise the vessel closed it
+        return not readable
+
+    # ------------------------------------------------------------------------------------------------------
+    # Take a connection towards vessel_ip, waiting if all of its sockets are busy
+    def acquire(self, vessel_ip):
+        with self.condition:
+            while True:
+                idle = self.idle.setdefault(vessel_ip, [])
+                # we reuse the most recently used connection first
+                while idle:
+                    connection, last_used = idle.pop()
+                    if self.is_healthy(connection, last_used):
+                        return connection
+                    connection.close()
+                    self.opened[vessel_ip] -= 1
+                # we can still open a new socket towards this vessel
+                if self.opened.get(vessel_ip, 0) < self.max_per_vessel:
+                    self.opened[vessel_ip] = self.opened.get(vessel_ip, 0) + 1
+                    break
+                self.condition.wait()
+        # We contact vessel:port since we all use the same port
+        return HTTPConnection("%s:%d" % (vessel_ip, self.port), timeout=self.timeout)
+
+    # ------------------------------------------------------------------------------------------------------
+    # Give back a connection, it is kept open only if it can be used again
+    def release(self, vessel_ip, connection, reusable):
+        with self.condition:
+            if reusable:
+                self.idle[vessel_ip].append((connection, time()))
+            else:
+                connection.close()
+                self.opened[vessel_ip] -= 1
+            self.condition.notify()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Send a POST request to vessel_ip and return the HTTP status of the response
+    def post(self, vessel_ip, path, body, headers):
+        while True:
+            connection = self.acquire(vessel_ip)
+            # a reused socket may have been closed by the vessel since the health check
+            reused = connection.sock is not None
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                # the body must be read before the socket can carry the next request
+                response.read()
+            except socket.timeout:
+                # the vessel did not answer, we do not send the message twice
+                self.release(vessel_ip, connection, False)
+                raise
+            except Exception:
+                self.release(vessel_ip, connection, False)
+                if not reused:
+                    raise
+                # we try again on another socket
+                continue
+            self.release(vessel_ip, connection, not response.will_close)
+            return response.status
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Fan-out of the messages sent to the other vessels
+# Every vessel has its own FIFO queue of messages, and a fixed number of workers send them in parallel.
+# A vessel is handled by one worker at a time, so its messages keep their order, and a slow or dead
+# vessel only keeps one worker busy while the other vessels are still served by the rest of them
+class VesselFanout:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, parallelism):
+        # pending messages of each vessel: vessel_ip -> deque([(function, args), ...])
+        self.queues = {}
+        # vessels with pending messages and no worker on them
+        self.ready = Queue()
+        # protects the queues of the vessels
+        self.lock = Lock()
+        # the workers are started once and live as long as the server
+        for i in range(0, parallelism):
+            worker = Thread(target=self.work)
+            # We kill the process if we kill the server
+            worker.daemon = True
+            worker.start()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Queue a message for vessel_ip, function(*args) is called by a worker to send it
+    def send(self, vessel_ip, function, *args):
+        with self.lock:
+            queue = self.queues.setdefault(vessel_ip, deque())
+            queue.append((function, args))
+            # a vessel with older pending messages is already known by the workers
+            if len(queue) == 1:
+                self.ready.put(vessel_ip)
+
+    # ------------------------------------------------------------------------------------------------------
+    # Number of messages waiting for each vessel
+    def pending(self):
+        with self.lock:
+            return dict((vessel_ip, len(queue)) for vessel_ip, queue in self.queues.items())
+
+    # ------------------------------------------------------------------------------------------------------
+    # Loop of a worker: send the oldest message of a ready vessel
+    def work(self):
+        while True:
+            vessel_ip = self.ready.get()
+            with self.lock:
+                function, args = self.queues[vessel_ip][0]
+            try:
+                function(*args)
+            except Exception as e:
+                print "Error while sending to %s" % vessel_ip
+                print(e)
+            with self.lock:
+                queue = self.queues[vessel_ip]
+                queue.popleft()
+                # the vessel goes back in the ready queue, after the other ready vessels
+                if len(queue) > 0:
+                    self.ready.put(vessel_ip)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# Outbound sender queue
+# The propagation work of the requests goes into one bounded queue drained by a fixed set of workers,
+# instead of a new thread per request. When the queue is full the caller waits, or its work is rejected
+class SenderQueue:
+    # ------------------------------------------------------------------------------------------------------
+    def __init__(self, workers, size, block):
+        # pending work: (function, args)
+        self.queue = Queue(size)
+        # wait for a free place when the queue is full, or reject the work
+        self.block = block
+        # the workers are started once and live as long as the server
+        for i in range(0, workers):
+            worker = Thread(target=self.work)
+            # We kill the process if we kill the server
+            worker.daemon = True
+            worker.start()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Queue function(*args), we return False if it was rejected because the queue is full
+    def submit(self, function, *args):
+        if self.block and self.full():
+            print "Sender queue full (%d waiting), %s waits" % (self.depth(), function.__name__)
+        try:
+            self.queue.put((function, args), self.block)
+        except Full:
+            print "Sender queue full (%d waiting), %s rejected" % (self.depth(), function.__name__)
+            return False
+        return True
+
+    # ------------------------------------------------------------------------------------------------------
+    # The queue is full: a work submitted now waits for a place, or is rejected
+    def full(self):
+        return self.queue.full()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Number of works waiting in the queue
+    def depth(self):
+        return self.queue.qsize()
+
+    # ------------------------------------------------------------------------------------------------------
+    # Loop of a worker
+    def work(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                print "Error in %s" % function.__name__
+                print(e)
+
+# ------------------------------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------------------------------
+# State of a connection served by the event loop
+class EventLoopConnection:
+    def __init__(self, address):
+        # address of the browser or vessel
+        self.address = address
+        # bytes received and not handled yet
+        self.input = ""
+        # bytes of the responses not sent yet
+        self.output = ""
+        # the connection is closed once the output is sent
+        self.close = False
+
+    # ------------------------------------------------------------------------------------------------------
+    # Take the first complete request (headers and Content-Length bytes of body) out of the input
+    def next_request(self):
+        end = self.input.find("\r\n\r\n")
+        if end < 0:
+            return None
+        length = 0
+        for line in self.input[:end].split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                try:
+                    length = int(value)
+                except ValueError:
+                    length = 0
+        size = end + 4 + length
+        if len(self.input) < size:
+            return None
+        request = self.input[:size]
+        self.input = self.input[size:]
+        return request
+
+
+# ------------------------------------------------------------------------------------------------------
+# Event loop serving engine
+# One thread waits with select() on the listening socket and on every open connection. A request is read
+# without blocking until it is complete, handled from memory by the request handler, and its response is
+# written back without blocking, so many polling browsers and vessels cost one socket each, not one thread
+class EventLoopMixIn:
+    # bytes read from a socket at once
+    read_size = 65536
+
+    # ------------------------------------------------------------------------------------------------------
+    def serve_forever(self, poll_interval=0.5):
+        # open connections: socket -> EventLoopConnection
+        self.connections = {}
+        self.listening = True
+        self.socket.setblocking(0)
+        while self.listening:
+            readers = [self.socket] + self.connections.keys()
+            writers = [sock for sock, connection in self.connections.items() if connection.output]
+            try:
+                readable, writable = select(readers, writers, [], poll_interval)[:2]
+            except select_error as e:
+                # interrupted by a signal, we wait again
+                if e.args[0] == EINTR:
+                    continue
+                raise
+            for sock in readable:
+                if sock is self.socket:
+                    self.accept_connection()
+                elif sock in self.connections:
+                    self.read_connection(sock)
+            for sock in writable:
+                if sock in self.connections:
+                    self.write_connection(sock)
+
+    # ------------------------------------------------------------------------------------------------------
+    def shutdown(self):
+        self.listening = False
+
+    # ------------------------------------------------------------------------------------------------------
+    def server_close(self):
+        for sock in getattr(self, "connections", {}).keys():
+            self.close_connection(sock)
+        HTTPServer.server_close(self)
+
+    # ------------------------------------------------------------------------------------------------------
+    def accept_connection(self):
+        try:
+            sock, address = self.socket.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        # the responses are written in one piece, there is nothing to wait for
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[sock] = EventLoopConnection(address)
+
+    # ------------------------------------------------------------------------------------------------------
+    def close_connection(self, sock):
+        del self.connections[sock]
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    # ------------------------------------------------------------------------------------------------------
+    def read_connection(self, sock):
+        connection = self.connections[sock]
+        try:
+            data = sock.recv(self.read_size)
+        except socket.error as e:
+            if e.args[0] in (EAGAIN, EWOULDBLOCK):
+                return
+            data = ""
+        # the browser or vessel closed the connection
+        if not data:
+            self.close_connection(sock)
+            return
+        connection.input += data
+        # several requests may be pipelined on the same connection
+        while not connection.close:
+            request = connection.next_request()
+            if request is None:
+                break
+            self.handle_buffered_request(connection, request)
+        self.write_connection(sock)
+
+    # ------------------------------------------------------------------------------------------------------
+    def write_connection(self, sock):
+        connection = self.connections[sock]
+        if connection.output:
+            try:
+                sent = sock.send(connection.output)
+            except socket.error as e:
+                if e.args[0] in (EAGAIN, EWOULDBLOCK):
+                    return
+                self.close_connection(sock)
+                return
+            connection.output = connection.output[sent:]
+        if not connection.output and connection.close:
+            self.close_connection(sock)
+
+    # ------------------------------------------------------------------------------------------------------
+    # The request handler reads the request from memory and writes its response in memory, the socket is
+    # never touched by it (setup() and finish() of the handler are not used)
+    def handle_buffered_request(self, connection, request):
+        # the handler is created without calling its __init__, which would serve the socket itself
+        handler = InstanceType(self.RequestHandlerClass)
+        handler.server = self
+        handler.request = None
+        handler.client_address = connection.address
+        handler.rfile = StringIO(request)
+        handler.wfile = StringIO()
+        handler.close_connection = 1
+        try:
+            handler.handle_one_request()
+        except Exception:
+            self.handle_error(None, connection.address)
+            handler.close_connection = 1
+        connection.output += handler.wfile.getvalue()
+        connection.close = bool(handler.close_connection)
+
 # ------------------------------------------------------------------------------------------------------
 
 
 # ------------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------------
 class BlackboardServer(HTTPServer):
+    # the requests can wait for a place in the sender queue (SENDER_QUEUE_BLOCK)
+    sender_waits = True
     # ------------------------------------------------------------------------------------------------------
     def __init__(self, server_address, handler, node_id, vessel_list):
         # We call the super init
@@ -44,6 +489,12 @@ class BlackboardServer(HTTPServer):
         self.vessel_id = vessel_id
         # The list of other vessels
         self.vessels = vessel_list
+        # The persistent connections to the other vessels
+        self.connection_pool = VesselConnectionPool(PORT_NUMBER)
+        # The workers sending the messages to the other vessels
+        self.fanout = VesselFanout(FANOUT_PARALLELISM)
+        # The workers running the propagation of the requests
+        self.sender = SenderQueue(SENDER_WORKERS, SENDER_QUEUE_SIZE, SENDER_QUEUE_BLOCK and self.sender_waits)
 
         self.vote = 0
         self.byzantine_votes = []
@@ -54,31 +505,37 @@ class BlackboardServer(HTTPServer):
         self.vectors = {}
 
         self.result = ""
+        # Version of the result, incremented each time it is calculated
+        self.result_version = 0
+        # Start of the server (in ms), in the ETags of the versions of the result
+        self.started = int(time() * 1000)
 
 
+    # ------------------------------------------------------------------------------------------------------
+    # The state of the outbound queues for the monitoring (/api/status): the works waiting in the sender queue
+    # and the messages waiting in the fan-out for each vessel
+    def queue_status(self):
+        return {'sender_queue': self.sender.depth(), 'fanout': self.fanout.pending()}
+
         # ------------------------------------------------------------------------------------------------------
         # Contact a specific vessel with a set of variables to transmit to it
 
     def contact_vessel(self, vessel_ip, path, action, key, value):
+        # The variables are sent in the binary format of the messages between vessels
+        post_content = encode_messages(['path', 'action', 'key', 'value'], [(path, action, key, value)])
+        return self.post_to_vessel(vessel_ip, "/replication", post_content, BINARY_CONTENT_TYPE)
+
+    # ------------------------------------------------------------------------------------------------------
+    # Send an encoded content to a specific vessel
+    def post_to_vessel(self, vessel_ip, path, post_content, content_type="application/x-www-form-urlencoded"):
         # the Boolean variable we will return
         success = False
-        # The variables must be encoded in the URL format, through urllib.urlencode
-        post_content = urlencode({'action': action, 'key': key, 'value': value})
-        # the HTTP header must contain the type of data we are transmitting, here URL encoded
-        headers = {"Content-type": "application/x-www-form-urlencoded"}
+        # the HTTP header must contain the type of data we are transmitting, URL encoded or binary
+        headers = {"Content-type": content_type}
         # We should try to catch errors when contacting the vessel
         try:
-            # We contact vessel:PORT_NUMBER since we all use the same port
-            # We can set a timeout, after which the connection fails if nothing happened
-            connection = HTTPConnection("%s:%d" % (vessel_ip, PORT_NUMBER), timeout=30)
-            # We only use POST to send data (PUT and DELETE not supported)
-            action_type = "POST"
-            # We send the HTTP request
-            connection.request(action_type, path, post_content, headers)
-            # We retrieve the response
-            response = connection.getresponse()
-            # We want to check the status, the body should be empty
-            status = response.status
+            # We reuse a kept-alive connection of the pool when possible (PUT and DELETE not supported)
+            status = self.connection_pool.post(vessel_ip, path, post_content, headers)
             # If we receive a HTTP 200 - OK
             if status == 200:
                 success = True
@@ -100,14 +557,15 @@ class BlackboardServer(HTTPServer):
             if vessel != ("10.1.0.%s" % self.vessel_id):
                 # A good practice would be to try again if the request failed
                 # Here, we do it only once
-                self.contact_vessel(vessel, path, action, key, value)
+                # The message waits in the queue of the vessel, the vessels are contacted in parallel
+                self.fanout.send(vessel, self.contact_vessel, vessel, path, action, key, value)
 
     #byzantine behaviour, here different votes might be sent to different vessels
     def byzantine_value_to_vessels(self, path, action, key, value):
         i = 0
         for vessel in self.vessels:
             if vessel != ("10.1.0.%s" % self.vessel_id):
-                self.contact_vessel(vessel, path, action, key, value[i])
+                self.fanout.send(vessel, self.contact_vessel, vessel, path, action, key, value[i])
                 i += 1
 
 
@@ -117,6 +575,25 @@ class BlackboardServer(HTTPServer):
 
 
 
+# ------------------------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------------------------
+# Serving engines
+# threads: every connection is handled by its own thread
+class ThreadedBlackboardServer(ThreadingMixIn, BlackboardServer):
+    # the persistent connections of the other vessels must not block each other
+    daemon_threads = True
+
+# select: every connection is handled by a single event loop
+class EventLoopBlackboardServer(EventLoopMixIn, BlackboardServer):
+    # a request waiting for a place in the sender queue would stop the loop: its propagation is rejected,
+    # and the writes of our own are refused (503) while the queue is full
+    sender_waits = False
+
+SERVING_ENGINES = {"threads": ThreadedBlackboardServer, "select": EventLoopBlackboardServer}
+# ------------------------------------------------------------------------------------------------------
+
+
+
 # ------------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------------
 # This class implements the logic when a server receives a GET or POST request
@@ -124,27 +601,69 @@ class BlackboardServer(HTTPServer):
 # i.e. the store is accessible through self.server.store
 # Attributes of the server are SHARED accross all request hqndling/ threads!
 class BlackboardRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 lets the other vessels (and the browsers) reuse their connection for the next request
+    protocol_version = "HTTP/1.1"
+    # the headers are written one by one, without Nagle they are not delayed on a kept-alive socket
+    disable_nagle_algorithm = True
     # ------------------------------------------------------------------------------------------------------
     # We fill the HTTP headers
-    def set_HTTP_headers(self, status_code=200):
+    def set_HTTP_headers(self, status_code=200, length=0, content_type="text/html", etag=None):
         # We set the response status code (200 if OK, something else otherwise)
         self.send_response(status_code)
-        # We set the content type to HTML
-        self.send_header("Content-type", "text/html")
+        # We set the content type, HTML for the pages
+        self.send_header("Content-type", content_type)
+        # The length of the body is needed to keep the connection open after the response
+        self.send_header("Content-Length", str(length))
+        # The version of the page, the browser must ask with it (If-None-Match) before using its copy
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
         # No more important headers, we can close them
         self.end_headers()
 
+    # ------------------------------------------------------------------------------------------------------
+    # The strong ETag of a version of the page (the versions restart with the server, not the ETags)
+    def version_etag(self, version):
+        return '"%d-%d"' % (self.server.started, version)
+
+    # ------------------------------------------------------------------------------------------------------
+    # We answer 304 (Not Modified), without body, if the browser already has this version of the page
+    def not_modified(self, etag):
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if etag not in tags and 'W/' + etag not in tags and '*' not in tags:
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return True
+
     # ------------------------------------------------------------------------------------------------------
     # a POST request must be parsed through urlparse.parse_QS, since the content is URL encoded
     def parse_POST_request(self):
         post_data = ""
         # We need to parse the response, so we must know the length of the content
         length = int(self.headers['Content-Length'])
-        # we can now parse the content using parse_qs
-        post_data = parse_qs(self.rfile.read(length), keep_blank_values=1)
+        post_content = self.rfile.read(length)
+        # the other vessels send binary messages, the browsers send URL encoded forms
+        if self.headers.getheader('Content-type') == BINARY_CONTENT_TYPE:
+            post_data = decode_messages(post_content)
+        else:
+            # we can now parse the content using parse_qs
+            post_data = parse_qs(post_content, keep_blank_values=1)
         # we return the data
         return post_data
 
+    # ------------------------------------------------------------------------------------------------------
+    # The sender queue is full and the requests cannot wait for a place in it: we answer 503 and return True
+    def sender_refuses(self):
+        if self.server.sender.block or not self.server.sender.full():
+            return False
+        self.send_error(503, "Sender queue full, try again later")
+        return True
+
     # Compute byzantine votes for round 1, by trying to create
     # a split decision.
     # input:
@@ -193,6 +712,8 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 
         if self.path == '/vote/result':
             self.get_result()
+        elif self.path == '/api/status':
+            self.send_api_status()
         else:
             self.do_GET_Index()
         # ------------------------------------------------------------------------------------------------------
@@ -200,21 +721,34 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
         # ------------------------------------------------------------------------------------------------------
 
     def get_result(self):
-        # We set the response status code to 200 (OK)
-        self.set_HTTP_headers(200)
 
+        # the result and its version are read together (the result is calculated with the mutex)
+        with mutex:
+            version = self.server.result_version
+            result = self.server.result
+        etag = self.version_etag(version)
+        if self.not_modified(etag):
+            return
         #add the result string to the template
-        result = vote_result_template % self.server.result
+        result = vote_result_template % result
+        # We set the response status code to 200 (OK) and the length of the page
+        self.set_HTTP_headers(200, len(result), etag=etag)
         self.wfile.write(result)
 
+    # the depth of the outbound queues, for the monitoring (never cached)
+    def send_api_status(self):
+        body = json.dumps(self.server.queue_status())
+        self.set_HTTP_headers(200, len(body), "application/json")
+        self.wfile.write(body)
+
     def do_GET_Index(self):
-        # We set the response status code to 200 (OK)
-        self.set_HTTP_headers(200)
 
         #add the result string to the template
         result = vote_result_template % self.server.result
         html_response = vote_frontpage_template + result
 
+        # We set the response status code to 200 (OK) and the length of the page
+        self.set_HTTP_headers(200, len(html_response))
         self.wfile.write(html_response)
 
     # ------------------------------------------------------------------------------------------------------
@@ -231,7 +765,18 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
         # and set the headers for the client
 
         post_data = self.parse_POST_request()
+        # a vote of our own is refused while its propagation cannot be queued (it would never reach the
+        # other vessels), if the requests do not wait for a place in the sender queue
+        if 'action' not in post_data and self.sender_refuses():
+            return
         self.set_HTTP_headers(200)
+        # only one vote or vector is counted at a time, so a round starts only once
+        with mutex:
+            self.process_vote(post_data)
+
+    # ------------------------------------------------------------------------------------------------------
+    # We count a vote (round 1) or a vector (round 2) and start the next step when all of them are received
+    def process_vote(self, post_data):
         retransmit_round1 = False
         do_round2 = False
 
@@ -273,19 +818,13 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
 
             #propagate the vote, or the byzantine behaviour
             if self.server.byzantine:
-                thread = Thread(target=self.server.byzantine_value_to_vessels,
-                                args=(self.path, 'round1', self.server.vessel_id, self.server.byzantine_votes))
-                # We kill the process if we kill the server
-                thread.daemon = True
-                # We start the thread
-                thread.start()
+                # The propagation is queued for the workers of the sender
+                self.server.sender.submit(self.server.byzantine_value_to_vessels,
+                                          self.path, 'round1', self.server.vessel_id, self.server.byzantine_votes)
             else:
-                thread = Thread(target=self.server.propagate_value_to_vessels,
-                                args=(self.path, 'round1', self.server.vessel_id, self.server.vote))
-                # We kill the process if we kill the server
-                thread.daemon = True
-                # We start the thread
-                thread.start()
+                # The propagation is queued for the workers of the sender
+                self.server.sender.submit(self.server.propagate_value_to_vessels,
+                                          self.path, 'round1', self.server.vessel_id, self.server.vote)
 
         # if all votes are cast, start round 2
         if retransmit_round1 == True:
@@ -302,18 +841,14 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
                 self.server.byzantine_vectors = self.compute_byzantine_vote_round2(2, 3, 1)
 
                 # send own votes to other vessels
-                thread = Thread(target=self.server.byzantine_value_to_vessels,
-                                args=(self.path, 'round2', self.server.vessel_id, self.server.byzantine_vectors))
-                thread.daemon = True
-                thread.start()
+                self.server.sender.submit(self.server.byzantine_value_to_vessels,
+                                          self.path, 'round2', self.server.vessel_id, self.server.byzantine_vectors)
 
             # honest behaviour
             else:
                 # send own vector to other vessels
-                thread = Thread(target=self.server.propagate_value_to_vessels,
-                                args=(self.path, 'round2', self.server.vessel_id, myvotes))
-                thread.daemon = True
-                thread.start()
+                self.server.sender.submit(self.server.propagate_value_to_vessels,
+                                          self.path, 'round2', self.server.vessel_id, myvotes)
 
         #if all vectors are received, calculate and display result
         if do_round2 == True:
@@ -360,6 +895,7 @@ class BlackboardRequestHandler(BaseHTTPRequestHandler):
                 self.server.result += "Result: Attack"
             else:
                 self.server.result += "Result: Retreat"
+            self.server.result_version += 1
 
 
 # ------------------------------------------------------------------------------------------------------
@@ -375,20 +911,25 @@ if __name__ == '__main__':
     # .....
     vessel_list = []
     vessel_id = 0
+    serving_engine = SERVING_ENGINE
     # Checking the arguments
-    if len(sys.argv) != 3:  # 2 args, the script and the vessel name
-        print("Arguments: vessel_ID number_of_vessels")
+    # 2 args, the script and the vessel name, and optionally the serving engine
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] not in SERVING_ENGINES):
+        print("Arguments: vessel_ID number_of_vessels [threads|select]")
     else:
         # We need to know the vessel IP
         vessel_id = int(sys.argv[1])
         # We need to write the other vessels IP, based on the knowledge of their number
         for i in range(1, int(sys.argv[2]) + 1):
             vessel_list.append("10.1.0.%d" % i)  # We can add ourselves, we have a test in the propagation
+        # The serving engine can be chosen as third argument
+        if len(sys.argv) == 4:
+            serving_engine = sys.argv[3]
 
 
     # We launch a server
-    server = BlackboardServer(('', PORT_NUMBER), BlackboardRequestHandler, vessel_id, vessel_list)
-    print("Starting the server on port %d" % PORT_NUMBER)
+    server = SERVING_ENGINES[serving_engine](('', PORT_NUMBER), BlackboardRequestHandler, vessel_id, vessel_list)
+    print("Starting the server on port %d (%s engine)" % (PORT_NUMBER, serving_engine))
 
     try:
         server.serve_forever()